@@ -0,0 +1,297 @@
+"""
+Benchmarks for script.py
+
+ Run code in terminal: python benchmark.py 200000
+ Where 200000 is the number of synthetic trips written to a temporary csv (10K up to 50M)
+    python benchmark.py 200000 --save-baseline      --> store this run as the baseline for 200000 trips
+    python benchmark.py 200000                      --> exits with status 1 when a stage got slower / bigger
+    python benchmark.py 50000000 --stages columnar  --> row stages keep every trip as a dict (~1 KB each), so
+                                                        only the columnar stages are practical at that size
+    python benchmark.py 1000000 --write trips.csv   --> just write the synthetic csv
+    python benchmark.py --csv metro-bike-share-trip-data.csv  --> benchmark a real csv instead
+    python benchmark.py 200000 --timestamps         --> strptime vs parse_time comparison
+ """
+import argparse
+import csv
+import datetime as dt
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import script
+
+# Same header as metro-bike-share-trip-data.csv
+TRIP_COLUMNS = [
+    'Trip ID', 'Duration', 'Start Time', 'End Time',
+    'Starting Station ID', 'Starting Station Latitude', 'Starting Station Longitude',
+    'Ending Station ID', 'Ending Station Latitude', 'Ending Station Longitude',
+    'Bike ID', 'Plan Duration', 'Trip Route Category', 'Passholder Type',
+    'Starting Lat-Long', 'Ending Lat-Long',
+]
+
+# Downtown LA stations 3005 - 3082 spread over the same few km as the 2016 network (fixed layout for every seed)
+_layout = np.random.default_rng(3005)
+STATION_IDS = np.arange(3005, 3083)
+STATION_LATITUDES = 34.025 + _layout.random(len(STATION_IDS)) * 0.04
+STATION_LONGITUDES = -118.28 + _layout.random(len(STATION_IDS)) * 0.05
+
+# (Passholder Type, Plan Duration, share of trips)
+PASSHOLDER_TYPES = [
+    ('Walk-up', 0, 0.30),
+    ('Monthly Pass', 30, 0.58),
+    ('Flex Pass', 365, 0.08),
+    ('Staff Annual', 365, 0.04),
+]
+
+# Share of trips starting in each hour of the day (commute peaks around 8:00 and 17:00)
+HOUR_WEIGHTS = np.array([1, 1, 1, 1, 1, 2, 4, 8, 10, 7, 5, 6, 7, 7, 6, 6, 8, 10, 8, 6, 4, 3, 2, 1], dtype=float)
+HOUR_WEIGHTS /= HOUR_WEIGHTS.sum()
+
+FIRST_TRIP = np.datetime64('2016-07-07T00:00:00')
+FIRST_TRIP_ID = 1912818
+DAYS = 365
+ROUND_TRIP_SHARE = 0.1
+# Trips with an empty coordinate / empty Plan Duration, like the real export
+MISSING_SHARE = 0.01
+
+# Trips generated per chunk; fixed, so a seed always gives the same file whatever the size
+CHUNK_SIZE = 200000
+
+
+# Writes "rows" made-up trips to filename (same seed --> same file), in Start Time order
+def write_trip_csv(filename, rows, seed=0):
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(TRIP_COLUMNS)
+
+        for first in range(0, rows, CHUNK_SIZE):
+            writer.writerows(trip_chunk(first, min(CHUNK_SIZE, rows - first), rows, seed))
+
+
+# Rows first .. first + size of a "rows" trip file
+def trip_chunk(first, size, rows, seed):
+    generator = np.random.default_rng([seed, first // CHUNK_SIZE])
+    row_numbers = first + np.arange(size)
+
+    # Days climb with the row number so the file reads oldest trip first
+    days = np.sort(((row_numbers + generator.random(size)) / rows * DAYS).astype(np.int64))
+    seconds = (days * 86400 + generator.choice(24, size, p=HOUR_WEIGHTS) * 3600
+               + generator.integers(0, 3600, size))
+    start_times = FIRST_TRIP + seconds.astype('timedelta64[s]')
+
+    # Whole minutes, mostly short hops with a long tail (real Durations are multiples of 60)
+    durations = np.clip(np.round(generator.lognormal(2.7, 0.9, size)), 1, 1440).astype(np.int64) * 60
+    end_times = start_times + durations.astype('timedelta64[s]')
+
+    starts = generator.integers(0, len(STATION_IDS), size)
+    round_trips = generator.random(size) < ROUND_TRIP_SHARE
+    ends = np.where(round_trips, starts, generator.integers(0, len(STATION_IDS), size))
+
+    passholders = generator.choice(len(PASSHOLDER_TYPES), size, p=[share for _, _, share in PASSHOLDER_TYPES])
+    passholder_types = [PASSHOLDER_TYPES[i][0] for i in passholders.tolist()]
+    plan_durations = [PASSHOLDER_TYPES[i][1] for i in passholders.tolist()]
+
+    columns = [
+        (FIRST_TRIP_ID + row_numbers).tolist(),
+        durations.tolist(),
+        np.datetime_as_string(start_times, unit='s').tolist(),
+        np.datetime_as_string(end_times, unit='s').tolist(),
+        STATION_IDS[starts].tolist(),
+        missing(STATION_LATITUDES[starts], generator),
+        missing(STATION_LONGITUDES[starts], generator),
+        STATION_IDS[ends].tolist(),
+        missing(STATION_LATITUDES[ends], generator),
+        missing(STATION_LONGITUDES[ends], generator),
+        generator.integers(4727, 6729, size).tolist(),
+        # Walk-ups always carry Plan Duration 0; only passes ever have it blank
+        missing(np.array(plan_durations), generator, keep=passholders == 0),
+        ['Round Trip' if round_trip else 'One Way' for round_trip in (starts == ends).tolist()],
+        passholder_types,
+        [''] * size,
+        [''] * size,
+    ]
+    return zip(*columns)
+
+
+# Values as a list with MISSING_SHARE of them blanked out (never where "keep" is True)
+def missing(values, generator, keep=False):
+    values = values.tolist()
+    for i in np.flatnonzero((generator.random(len(values)) < MISSING_SHARE) & ~keep).tolist():
+        values[i] = ''
+    return values
+
+
+# Best wall time (seconds) of "repeat" calls to function()
+def best_time(function, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Peak memory (bytes) Python allocated during one call to function()
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def strptime_time(text):
+    return dt.datetime.strptime(text, script.TIME_FORMAT)
+
+
+def timestamp_benchmark(filename):
+    with open(filename, newline='') as csv_file:
+        texts = [row['Start Time'] for row in csv.DictReader(csv_file)]
+
+    strptime_seconds = best_time(lambda: [strptime_time(text) for text in texts])
+    fast_seconds = best_time(lambda: [script.parse_time(text) for text in texts])
+    print('Timestamps  strptime: {:.3f}s  parse_time: {:.3f}s  speedup: {:.1f}x'.format(
+        strptime_seconds, fast_seconds, strptime_seconds / fast_seconds))
+
+    # Whole parse(), once with the old strptime conversion swapped back in
+    fast_seconds = best_time(lambda: script.parse(filename))
+    script.parse_time, parse_time = strptime_time, script.parse_time
+    try:
+        strptime_seconds = best_time(lambda: script.parse(filename))
+    finally:
+        script.parse_time = parse_time
+    print('parse()     strptime: {:.3f}s  parse_time: {:.3f}s  speedup: {:.1f}x'.format(
+        strptime_seconds, fast_seconds, strptime_seconds / fast_seconds))
+
+
+# [(stage, 'row' / 'columnar', function), ...]; row stages share one parsed list, columnar ones one TripTable
+def stages(filename, kinds):
+    rows = script.parse(filename) if 'row' in kinds else []
+    table = script.TripTable.from_csv(filename) if 'columnar' in kinds else None
+
+    def distances():
+        for row in rows:
+            script.computed_distance(row['Starting Station Latitude'], row['Starting Station Longitude'],
+                                     row['Ending Station Latitude'], row['Ending Station Longitude'])
+
+    def aggregation(name):
+        return lambda: script.aggregate(rows, {name: script.main_accumulators()[name]})
+
+    def warm_main():
+        # The .npy cache is built once up front, so this times the everyday (cached) run
+        script.load_trip_table(filename)
+        return script.main(filename, columnar=True)
+
+    found = [
+        ('parse()', 'row', lambda: script.parse(filename)),
+        ('computed_distance', 'row', distances),
+    ]
+    found += [('aggregate: ' + name, 'row', aggregation(name)) for name in script.main_accumulators()]
+    found += [
+        ('main()', 'row', lambda: script.main(filename)),
+        ('TripTable.from_csv', 'columnar', lambda: script.TripTable.from_csv(filename)),
+        ('computed_distances', 'columnar',
+         lambda: script.computed_distances(*[table[column] for column in script.COORDINATE_COLUMNS])),
+        ('table_analyses', 'columnar', lambda: script.table_analyses(table)),
+        ('main(columnar=True)', 'columnar', warm_main),
+    ]
+    return [stage for stage in found if stage[1] in kinds]
+
+
+# {stage: {'seconds', 'rows_per_second', 'peak_mb'}}, printed as it goes
+def run_benchmarks(filename, kinds, repeat=3):
+    with open(filename, 'rb') as csv_file:
+        rows = sum(1 for _ in csv_file) - 1
+
+    results = {}
+    for stage, kind, function in stages(filename, kinds):
+        seconds = best_time(function, repeat)
+        peak_mb = peak_memory(function) / 2**20
+        results[stage] = {'seconds': seconds, 'rows_per_second': rows / seconds, 'peak_mb': peak_mb}
+        print('{:<55} {:>9.3f}s {:>13,.0f} rows/s {:>10.1f} MB'.format(stage, seconds, rows / seconds, peak_mb))
+
+    return rows, results
+
+
+# Stages slower or bigger than the baseline by more than "tolerance" (0.25 --> 25%)
+def regressions(results, baseline, tolerance):
+    found = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        # A few milliseconds of slack keeps tiny stages from failing on timer noise
+        if result['seconds'] > baseline[stage]['seconds'] * (1 + tolerance) + 0.005:
+            found.append('{}: {:.3f}s vs {:.3f}s'.format(stage, result['seconds'], baseline[stage]['seconds']))
+        if result['peak_mb'] > baseline[stage]['peak_mb'] * (1 + tolerance) + 1:
+            found.append('{}: {:.1f} MB vs {:.1f} MB'.format(stage, result['peak_mb'], baseline[stage]['peak_mb']))
+    return found
+
+
+def read_baselines(filename):
+    try:
+        with open(filename) as baseline_file:
+            return json.load(baseline_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def benchmark(filename, arguments):
+    rows, results = run_benchmarks(filename, arguments.stages.split(','), arguments.repeat)
+
+    # Baselines are kept per number of trips: {"200000": {stage: result}}
+    baselines = read_baselines(arguments.baseline)
+    if arguments.save_baseline:
+        baselines.setdefault(str(rows), {}).update(results)
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print('Saved baseline for {:,} trips to {}'.format(rows, arguments.baseline))
+        return 0
+
+    if str(rows) not in baselines:
+        print('No baseline for {:,} trips in {} (use --save-baseline)'.format(rows, arguments.baseline))
+        return 0
+
+    found = regressions(results, baselines[str(rows)], arguments.tolerance)
+    for regression in found:
+        print('REGRESSION', regression)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for script.py')
+    parser.add_argument('rows', nargs='?', type=int, default=200000, help='synthetic trips to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='benchmark this csv instead of a synthetic one')
+    parser.add_argument('--write', help='only write the synthetic csv to this file')
+    parser.add_argument('--stages', default='row,columnar', help='row, columnar or both (comma separated)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best one counts')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           'benchmark-baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown / growth (0.25 = 25%%)')
+    parser.add_argument('--timestamps', action='store_true', help='only compare strptime and parse_time')
+    arguments = parser.parse_args()
+
+    if arguments.write:
+        write_trip_csv(arguments.write, arguments.rows, arguments.seed)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = arguments.csv
+        if filename is None:
+            filename = os.path.join(directory, 'metro-bike-share-trip-data.csv')
+            write_trip_csv(filename, arguments.rows, arguments.seed)
+
+        if arguments.timestamps:
+            timestamp_benchmark(filename)
+            status = 0
+        else:
+            status = benchmark(filename, arguments)
+
+    sys.exit(status)
@@ -3,50 +3,623 @@ Run Code code in terminal to obtain data from 'parsed csv section' functions: ex
 
  Run code in terminal to obtain Plotly URLs: ex.) round_trip_and_oneway_routes_graph(x['Most Popular Trip Routes'])
  Where "x" = main() and is used to access the data in the main function
+
+ Analysis functions also accept a row stream for csv files larger than memory: ex.) trip_route_data(parse(stream=True))
+ Same dictionary from NumPy arrays instead of per-row dicts: ex.) x = main(columnar=True)
+ Same dictionary using every core: ex.) x = main(processes=8)
+ Every page at once: ex.) render_all(x) or render_all(x, offline=True) for local html without Plotly uploads
+ Where the time goes: ex.) x = main(profile=True) then x['Profile'] (or run with BIKESHARE_PROFILE=1)
  """
 import csv
 import datetime as dt
 from math import sin, cos, sqrt, atan2, radians
 import collections
+import contextlib
+import copy
+import cProfile
+import hashlib
+import heapq
+import json
+import multiprocessing
+import operator
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent import futures
+import numpy as np
 import plotly.plotly as ply
-import plotly.graph_objs as go
+import plotly.offline as plo
 import plotly.tools as tls
 
 # approximate radius of earth in km
 Radius_of_earth = 6373.0
 
 
+# Default location of the LA Metro trip export
+TRIP_DATA_CSV = "metro-bike-share-trip-data.csv"
+
+
 # parse() is just to manipulate the data to be more flexible for future purposes
-def parse():
-    reader = csv.DictReader(open("metro-bike-share-trip-data.csv"))
-    excel_rows = list(reader)
-    for row in excel_rows:
-        # Duration & Plan Duration --> converted to an integer
-        row['Duration'] = int(row['Duration'])
-        row['Plan Duration'] = int(row['Plan Duration'] or -1)
+# parse(stream=True) hands back a generator instead of a list so rows can be consumed one at a time
+# parse(columnar=True) hands back a TripTable (one NumPy array per column) instead of a list of dicts,
+# loaded from the binary cache next to the csv when the csv has not changed since the cache was written
+def parse(filename=TRIP_DATA_CSV, stream=False, columnar=False, cache=True):
+    if columnar:
+        return load_trip_table(filename, cache)
+    if stream:
+        return iter_parse(filename)
+    return list(iter_parse(filename))
+
+
+# Yields each row already converted, so only ONE row is held in memory at a time
+def iter_parse(filename=TRIP_DATA_CSV):
+    # "with" closes the file as soon as the generator is exhausted (or closed early)
+    with open(filename, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield convert_row(row)
+
+
+# The csv's timestamps all look like 2016-07-07T04:17:00
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def parse_time(text):
+    # Fast path: datetime.fromisoformat is C code and handles the fixed layout without strptime's format matching
+    if len(text) == 19 and text[4] == '-' and text[7] == '-' and text[10] == 'T' and text[13] == ':' and text[16] == ':':
+        try:
+            return dt.datetime.fromisoformat(text)
+        except ValueError:
+            pass
+
+    # Anything else goes through strptime, which accepts (or rejects) exactly what parse() always did
+    return dt.datetime.strptime(text, TIME_FORMAT)
+
+
+def convert_row(row):
+    # Duration & Plan Duration --> converted to an integer
+    row['Duration'] = int(row['Duration'])
+    row['Plan Duration'] = int(row['Plan Duration'] or -1)
+
+    # Reformatting the Times into datetime objects
+    row['Start Time'] = parse_time(row['Start Time'])
+
+    row['End Time'] = parse_time(row['End Time'])
+
+    # Starting Latitude & Longitude --> converted to float
+    row['Starting Station Latitude'] = float(
+        row['Starting Station Latitude'] or 0)
+
+    row['Starting Station Longitude'] = float(
+        row['Starting Station Longitude']or 0)
+
+    # Ending Latitude & Longitude --> converted to float
+    row['Ending Station Latitude'] = float(
+        row['Ending Station Latitude'] or 0)
+
+    row['Ending Station Longitude'] = float(
+        row['Ending Station Longitude'] or 0)
+
+    return row
+
+"""
+Columnar Trip Table Section
+
+ TripTable keeps every column of the csv as ONE NumPy array instead of one dict per trip:
+    Duration, Plan Duration             --> int64
+    Start Time, End Time                --> datetime64[s]
+    Station Latitudes & Longitudes      --> float64
+    Station IDs, Bike ID, Trip ID,
+    Trip Route Category, Passholder Type --> int32 codes into a list of labels
+"""
+
+# Categorical columns mapped to the label list their codes index into
+# Starting & Ending Station ID share one list, so a station has the same code in both columns
+CATEGORICAL_COLUMNS = {
+    'Trip ID': 'Trip ID',
+    'Starting Station ID': 'Station ID',
+    'Ending Station ID': 'Station ID',
+    'Bike ID': 'Bike ID',
+    'Trip Route Category': 'Trip Route Category',
+    'Passholder Type': 'Passholder Type',
+}
+
+COORDINATE_COLUMNS = [
+    'Starting Station Latitude',
+    'Starting Station Longitude',
+    'Ending Station Latitude',
+    'Ending Station Longitude',
+]
+
+TIME_COLUMNS = ['Start Time', 'End Time']
+
+
+class TripTable:
+
+    def __init__(self, columns, labels):
+        # columns: {column name: NumPy array}, labels: {label list name: [label, ...]}
+        self.columns = columns
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.columns['Duration'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    # The labels a categorical column's codes point at
+    def categories(self, column):
+        name = CATEGORICAL_COLUMNS[column]
+
+        # Labels read from the cache are mapped arrays until something needs them as Python strings
+        if not isinstance(self.labels[name], list):
+            self.labels[name] = self.labels[name].tolist()
+
+        return self.labels[name]
+
+    # Code of a single label, -1 if that label never shows up (so comparisons simply match nothing)
+    def code(self, column, label):
+        try:
+            return self.categories(column).index(label)
+        except ValueError:
+            return -1
+
+    # The trips as parse()-style rows, so the row based analyses can run straight off a (cached) table
+    # ex.) trip_route_data(parse(columnar=True).rows())
+    # Only chunk_size rows at a time are turned into Python objects
+    def rows(self, chunk_size=65536):
+        names = list(self.columns)
+
+        for start in range(0, len(self), chunk_size):
+            values = []
+            for column in names:
+                # .tolist() turns int64 --> int, float64 --> float and datetime64[s] --> datetime
+                part = self.columns[column][start:start + chunk_size].tolist()
+
+                if column in CATEGORICAL_COLUMNS:
+                    labels = self.categories(column)
+                    part = [labels[code] for code in part]
+                values.append(part)
+
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+    @classmethod
+    def from_csv(cls, filename=TRIP_DATA_CSV, chunk_size=1000000):
+        builder = _TripTableBuilder()
+
+        with open(filename, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader)
+            index = {name: i for i, name in enumerate(header)}
+
+            # Converting chunk by chunk keeps the raw strings for only chunk_size rows in memory
+            while True:
+                chunk = [row for _, row in zip(range(chunk_size), reader)]
+                if not chunk:
+                    break
+                builder.add_strings({name: [row[i] for row in chunk] for name, i in index.items()})
+
+        return builder.table()
+
+    # Builds a table out of rows that already went through convert_row() (ex.: parse() or parse(stream=True))
+    @classmethod
+    def from_rows(cls, rows, chunk_size=1000000):
+        builder = _TripTableBuilder()
+        chunk = []
+
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                builder.add_rows(chunk)
+                chunk = []
+        if chunk:
+            builder.add_rows(chunk)
+
+        return builder.table()
+
+
+# A whole column of timestamps at once: NumPy converts the ISO strings in one batch,
+# and a chunk holding anything but the exact 2016-07-07T04:17:00 layout falls back to parse_time() one string
+# at a time (NumPy alone would quietly accept '', 'NaT', '2016-07-07', a trailing 'Z', ...)
+def parse_times(texts):
+    if iso_layout(texts):
+        try:
+            return np.array(texts, dtype='datetime64[s]')
+        except ValueError:
+            pass
+    return np.array([parse_time(text) for text in texts], dtype='datetime64[s]')
+
+
+# Character positions of the separators in TIME_FORMAT's output; every other position is a digit
+TIME_SEPARATORS = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':'}
+
+
+# True when every text is exactly 19 characters laid out like 2016-07-07T04:17:00 (same test as parse_time())
+def iso_layout(texts):
+    if not len(texts) or min(map(len, texts)) != 19 or max(map(len, texts)) != 19:
+        return False
+    try:
+        data = ''.join(texts).encode('ascii')
+    except UnicodeEncodeError:
+        return False
+
+    # One row of 19 bytes per text
+    characters = np.frombuffer(data, dtype=np.uint8).reshape(len(texts), 19)
+    digits = [position for position in range(19) if position not in TIME_SEPARATORS]
+    return bool(((characters[:, digits] >= ord('0')) & (characters[:, digits] <= ord('9'))).all()
+                and all((characters[:, position] == ord(separator)).all()
+                        for position, separator in TIME_SEPARATORS.items()))
+
+
+# Collects converted column chunks and hands out category codes in order of first appearance
+class _TripTableBuilder:
+
+    def __init__(self):
+        self.chunks = collections.defaultdict(list)
+        self.codes = {name: {} for name in set(CATEGORICAL_COLUMNS.values())}
+
+    def encode(self, column, values):
+        codes = self.codes[CATEGORICAL_COLUMNS[column]]
+        # setdefault hands a new label the next free code
+        return np.fromiter((codes.setdefault(value, len(codes)) for value in values),
+                           dtype=np.int32, count=len(values))
+
+    # Raw csv strings --> same conversions as convert_row(), but for a whole column at once
+    def add_strings(self, strings):
+        chunks = self.chunks
+
+        chunks['Duration'].append(np.array(strings['Duration']).astype(np.int64))
+
+        # Empty Plan Duration --> -1, swapped in before the array is built: a chunk of only '' & '0' makes a
+        # one character wide array that would cut '-1' down to '-'
+        plan_duration = np.array([value or '-1' for value in strings['Plan Duration']])
+        chunks['Plan Duration'].append(plan_duration.astype(np.int64))
+
+        for column in TIME_COLUMNS:
+            chunks[column].append(parse_times(strings[column]))
+
+        # Empty Latitude & Longitude --> 0
+        for column in COORDINATE_COLUMNS:
+            coordinates = np.array(strings[column])
+            coordinates[coordinates == ''] = '0'
+            chunks[column].append(coordinates.astype(np.float64))
+
+        for column in CATEGORICAL_COLUMNS:
+            chunks[column].append(self.encode(column, strings[column]))
+
+    def add_rows(self, rows):
+        chunks = self.chunks
+
+        for column in ['Duration', 'Plan Duration']:
+            chunks[column].append(np.array([row[column] for row in rows], dtype=np.int64))
+
+        for column in TIME_COLUMNS:
+            chunks[column].append(np.array([row[column] for row in rows], dtype='datetime64[s]'))
+
+        for column in COORDINATE_COLUMNS:
+            chunks[column].append(np.array([row[column] for row in rows], dtype=np.float64))
+
+        for column in CATEGORICAL_COLUMNS:
+            chunks[column].append(self.encode(column, [row[column] for row in rows]))
+
+    def table(self):
+        dtypes = dict.fromkeys(['Duration', 'Plan Duration'], np.int64)
+        dtypes.update(dict.fromkeys(TIME_COLUMNS, 'datetime64[s]'))
+        dtypes.update(dict.fromkeys(COORDINATE_COLUMNS, np.float64))
+        dtypes.update(dict.fromkeys(CATEGORICAL_COLUMNS, np.int32))
+
+        columns = {}
+        for column, dtype in dtypes.items():
+            chunks = self.chunks[column]
+            columns[column] = np.concatenate(chunks) if chunks else np.array([], dtype=dtype)
+
+        labels = {name: list(codes) for name, codes in self.codes.items()}
+        return TripTable(columns, labels)
+
+
+"""
+Trip Cache Section
+
+ The first parse(columnar=True) of a csv saves its TripTable next to it:
+    metro-bike-share-trip-data.csv.cache/
+        cache.json                              --> CACHE_VERSION, size, mtime & sha1 of the csv + which build folder is current
+        <build folder>/
+            Duration.npy, Start-Time.npy, ...   --> one typed .npy file per column
+            labels-Station-ID.npy, ...          --> the labels behind each categorical column's codes
+ Later runs memory-map those files read-only instead of re-reading the csv
+ The columns are numpy.memmap views of the files, so every process opening the same cache shares
+ one copy of the data through the OS page cache (ex.: several dashboards on the same month)
+"""
+
+
+# Bump whenever cache.json, manifest.json or the build folders change layout; older caches are then rebuilt
+CACHE_VERSION = 2
+
+
+def cache_directory(filename):
+    return filename + '.cache'
+
+
+# 'Start Time' --> 'Start-Time.npy'
+def cache_file(directory, name):
+    return os.path.join(directory, name.replace(' ', '-') + '.npy')
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_trip_table(filename=TRIP_DATA_CSV, cache=True):
+    if not cache:
+        return TripTable.from_csv(filename)
+
+    table = read_trip_cache(filename)
+    if table is None:
+        table = TripTable.from_csv(filename)
+        try:
+            write_trip_cache(filename, table)
+        except OSError:
+            # A read-only data folder only costs us the cache, not the result
+            pass
+
+    return table
+
+
+def write_trip_cache(filename, table):
+    directory = cache_directory(filename)
+
+    signature = file_signature(filename)
+    sha1 = file_hash(filename)
+    build = new_build(directory, sha1)
+
+    for column, values in table.columns.items():
+        np.save(cache_file(build, column), values)
+
+    for name, labels in table.labels.items():
+        np.save(cache_file(build, 'labels ' + name), np.asarray(labels, dtype=str))
+
+    metadata = dict(signature, sha1=sha1, rows=len(table), build=os.path.basename(build),
+                    columns=list(table.columns), labels=list(table.labels))
+    write_cache_metadata(directory, metadata)
+    drop_old_builds(directory, metadata['build'])
+
 
-        # Reformatting the Times into datetime objects
-        row['Start Time'] = dt.datetime.strptime(
-            row['Start Time'], '%Y-%m-%dT%H:%M:%S')
+# Every build gets a NEW folder: files other processes have memory-mapped are never rewritten in place
+def new_build(directory, sha1):
+    os.makedirs(directory, exist_ok=True)
+    build = tempfile.mkdtemp(prefix=sha1[:12] + '-', dir=directory)
+    # mkdtemp makes the folder private; other users' dashboards need to read it too
+    os.chmod(build, 0o755)
+    return build
 
-        row['End Time'] = dt.datetime.strptime(
-            row['End Time'], '%Y-%m-%dT%H:%M:%S')
 
-        # Starting Latitude & Longitude --> converted to float
-        row['Starting Station Latitude'] = float(
-            row['Starting Station Latitude'] or 0)
+# Once the metadata points at "build", older builds can go: processes that already mapped them keep their pages
+def drop_old_builds(directory, build):
+    for entry in os.listdir(directory):
+        if entry != build and os.path.isdir(os.path.join(directory, entry)):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
 
-        row['Starting Station Longitude'] = float(
-            row['Starting Station Longitude']or 0)
 
-        # Ending Latitude & Longitude --> converted to float
-        row['Ending Station Latitude'] = float(
-            row['Ending Station Latitude'] or 0)
+# cache.json is swapped in with one os.replace, so readers see either the old build or the new one
+def write_cache_metadata(directory, metadata, name='cache.json'):
+    temporary = os.path.join(directory, '{}.{}'.format(name, os.getpid()))
+    with open(temporary, 'w') as metadata_file:
+        json.dump(dict(metadata, version=CACHE_VERSION), metadata_file)
+    os.replace(temporary, os.path.join(directory, name))
 
-        row['Ending Station Longitude'] = float(
-            row['Ending Station Longitude'] or 0)
 
-    return excel_rows
+# Fields cache.json and manifest.json both carry
+CACHE_FIELDS = {'size', 'mtime_ns', 'sha1', 'rows', 'build', 'columns', 'labels'}
+
+
+# None when there is no metadata, it was written in another CACHE_VERSION or misses fields, so callers simply rebuild
+def read_cache_metadata(directory, name='cache.json'):
+    try:
+        with open(os.path.join(directory, name)) as metadata_file:
+            metadata = json.load(metadata_file)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(metadata, dict) or metadata.get('version') != CACHE_VERSION or not CACHE_FIELDS <= set(metadata):
+        return None
+    return metadata
+
+
+# True when the metadata (cache.json, manifest.json, ...) in "directory" was written for the csv as it is now
+def source_is_current(filename, directory, metadata, name='cache.json'):
+    signature = file_signature(filename)
+
+    # A different size always means new data; a different mtime alone (ex.: the csv was copied) is settled by the hash
+    if metadata['size'] != signature['size']:
+        return False
+    if metadata['mtime_ns'] != signature['mtime_ns']:
+        if metadata['sha1'] != file_hash(filename):
+            return False
+
+        # Same bytes: remember the new mtime so the next run skips the hash
+        metadata['mtime_ns'] = signature['mtime_ns']
+        try:
+            write_cache_metadata(directory, metadata, name)
+        except OSError:
+            pass
+
+    return True
+
+
+# TripTable from the cache, or None when there is no cache or the csv changed since it was written
+def read_trip_cache(filename):
+    directory = cache_directory(filename)
+
+    metadata = read_cache_metadata(directory)
+    if metadata is None or not source_is_current(filename, directory, metadata):
+        return None
+
+    return open_trip_cache(directory, metadata)
+
+
+# Maps a cache folder without looking at the csv at all (ex.: a dashboard host that only has the cache)
+def open_trip_cache(directory, metadata=None):
+    metadata = metadata or read_cache_metadata(directory)
+    if metadata is None:
+        return None
+
+    build = os.path.join(directory, metadata['build'])
+
+    try:
+        # mmap_mode='r' --> read-only numpy.memmap, nothing is copied until a page is actually touched
+        columns = {column: np.load(cache_file(build, column), mmap_mode='r')
+                   for column in metadata['columns']}
+        # Labels stay as mapped arrays too; TripTable.categories() turns one into a list only when asked
+        labels = {name: np.load(cache_file(build, 'labels ' + name), mmap_mode='r')
+                  for name in metadata['labels']}
+    except (OSError, ValueError):
+        # ex.: a newer build replaced this one between reading cache.json and mapping the files
+        return None
+
+    return TripTable(columns, labels)
+
+
+"""
+Partition Section
+
+ partition_trips() splits the trips by the day or month of their Start Time:
+    metro-bike-share-trip-data.csv.partitions/
+        manifest.json                           --> CACHE_VERSION, size, mtime & sha1 of the csv, "by", build folder and
+                                                    every partition's rows plus min & max of its typed columns
+        <build folder>/
+            labels-Station-ID.npy, ...          --> ONE set of labels, so a code means the same thing in every partition
+            2016-07/Duration.npy, ...           --> one folder of typed .npy columns per month (or day)
+ A date range then only maps the partitions it overlaps
+ Run code in terminal: trips = load_partitions(); trip_route_data(trips.rows('2016-08-01', '2016-08-07'))
+    query(trips).filter(start='2016-08-01', end='2016-08-07') --> the query only opens August
+"""
+
+# Partition by the day ('D') or month ('M') of Start Time
+PARTITION_UNITS = {'day': 'D', 'month': 'M'}
+
+
+def partition_directory(filename):
+    return filename + '.partitions'
+
+
+# Partitions of the csv, re-partitioned first when there are none yet, the csv changed or "by" differs
+def load_partitions(filename=TRIP_DATA_CSV, by='month'):
+    directory = partition_directory(filename)
+    manifest = read_cache_metadata(directory, 'manifest.json')
+
+    if manifest is None or manifest['by'] != by or not source_is_current(filename, directory, manifest, 'manifest.json'):
+        partition_trips(filename, by)
+
+    return open_partitions(directory)
+
+
+def partition_trips(filename=TRIP_DATA_CSV, by='month', table=None):
+    if by not in PARTITION_UNITS:
+        raise ValueError('by must be one of {}, not {!r}'.format(list(PARTITION_UNITS), by))
+
+    table = table if table is not None else load_trip_table(filename)
+    directory = partition_directory(filename)
+
+    signature = file_signature(filename)
+    sha1 = file_hash(filename)
+    # A new build folder each time, same as the trip cache: mapped files are never rewritten in place
+    build = new_build(directory, sha1)
+
+    for name, labels in table.labels.items():
+        np.save(cache_file(build, 'labels ' + name), np.asarray(labels, dtype=str))
+
+    # Stable sort: inside a partition the trips keep their csv order
+    keys = table['Start Time'].astype('datetime64[' + PARTITION_UNITS[by] + ']')
+    order = np.argsort(keys, kind='stable')
+    values, first_rows, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    partitions = []
+    for value, start, rows in zip(values, first_rows.tolist(), counts.tolist()):
+        name = str(value)
+        rows_here = order[start:start + rows]
+        os.makedirs(os.path.join(build, name))
+
+        summary = {'name': name, 'rows': rows, 'min': {}, 'max': {}}
+        for column, column_values in table.columns.items():
+            part = column_values[rows_here]
+            np.save(cache_file(os.path.join(build, name), column), part)
+
+            # Codes of categorical columns say nothing on their own, so only real values are summarised
+            if column not in CATEGORICAL_COLUMNS:
+                summary['min'][column] = str(part.min()) if column in TIME_COLUMNS else part.min().item()
+                summary['max'][column] = str(part.max()) if column in TIME_COLUMNS else part.max().item()
+        partitions.append(summary)
+
+    manifest = dict(signature, sha1=sha1, by=by, rows=len(table), build=os.path.basename(build),
+                    columns=list(table.columns), labels=list(table.labels), partitions=partitions)
+    write_cache_metadata(directory, manifest, 'manifest.json')
+    drop_old_builds(directory, manifest['build'])
+
+
+# Maps a partition folder without looking at the csv, like open_trip_cache()
+def open_partitions(directory):
+    manifest = read_cache_metadata(directory, 'manifest.json')
+    if manifest is None:
+        return None
+    return PartitionedTrips(directory, manifest)
+
+
+class PartitionedTrips:
+
+    def __init__(self, directory, manifest):
+        self.manifest = manifest
+        self.build = os.path.join(directory, manifest['build'])
+        # Shared by every partition's TripTable, so each label list is turned into Python strings only once
+        self.labels = {name: np.load(cache_file(self.build, 'labels ' + name), mmap_mode='r')
+                       for name in manifest['labels']}
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    # Manifest entries whose Start Time range overlaps first_day..last_day (None = open ended)
+    def partitions(self, first_day=None, last_day=None):
+        chosen = []
+        for partition in self.manifest['partitions']:
+            if first_day is not None and np.datetime64(partition['max']['Start Time'], 'D') < np.datetime64(first_day, 'D'):
+                continue
+            if last_day is not None and np.datetime64(partition['min']['Start Time'], 'D') > np.datetime64(last_day, 'D'):
+                continue
+            chosen.append(partition)
+        return chosen
+
+    # Memory-mapped TripTables of the overlapping partitions (they may hold trips just outside the range)
+    def tables(self, first_day=None, last_day=None):
+        return [TripTable({column: np.load(cache_file(os.path.join(self.build, partition['name']), column),
+                                           mmap_mode='r')
+                           for column in self.manifest['columns']}, self.labels)
+                for partition in self.partitions(first_day, last_day)]
+
+    # Exactly the trips from first_day to last_day (inclusive) as one TripTable
+    def table(self, first_day=None, last_day=None):
+        trips = Query(self)
+        if first_day is not None:
+            trips = trips.filter(start=first_day)
+        if last_day is not None:
+            trips = trips.filter(end=last_day)
+        return trips.table()
+
+    # parse()-style rows of the range, for the row based analyses (ex.: plan_duration_and_passholder_type)
+    def rows(self, first_day=None, last_day=None):
+        return self.table(first_day, last_day).rows()
+
 
 # To calculate average distance of Latitude(s) & Longitude(s)
 
@@ -70,40 +643,123 @@ def computed_distance(latitude1, longitude1, latitude2, longitude2):
     return final_answer
 
 
-def main():
+# Batch version of computed_distance(): takes arrays of coordinates and evaluates every trip in one go
+# Trips with any coordinate equal to 0 (empty in the csv) are dropped, same as main() always did
+# Returns (distances of the kept trips, their mean)
+def computed_distances(latitudes1, longitudes1, latitudes2, longitudes2):
 
-    # rows yields all manipulated data
-    rows = parse()
+    latitudes1 = np.asarray(latitudes1, dtype=np.float64)
+    longitudes1 = np.asarray(longitudes1, dtype=np.float64)
+    latitudes2 = np.asarray(latitudes2, dtype=np.float64)
+    longitudes2 = np.asarray(longitudes2, dtype=np.float64)
 
-    # append computations from computed_distance() into average_distances_total
-    average_distances_total = []
-    for row in rows:
-        # Taking into account potential empty strings that may corrupt data
-        if (
-            row['Starting Station Latitude'] == 0
-            or row['Starting Station Longitude'] == 0
-            or row['Ending Station Latitude'] == 0
-            or row['Ending Station Longitude'] == 0
-        ):
-            continue
-
-        average_distances_total.append(computed_distance(
-            row['Starting Station Latitude'],
-            row['Starting Station Longitude'],
-            row['Ending Station Latitude'],
-            row['Ending Station Longitude']
-        ))
+    # Taking into account potential empty strings that may corrupt data
+    filled = (latitudes1 != 0) & (longitudes1 != 0) & (latitudes2 != 0) & (longitudes2 != 0)
+
+    distances = haversine(latitudes1[filled], longitudes1[filled],
+                          latitudes2[filled], longitudes2[filled])
+
+    # No usable trips --> nan rather than a ZeroDivisionError
+    mean = float(distances.mean()) if len(distances) else float('nan')
+
+    return distances, mean
+
+
+# computed_distance() for NumPy arrays (any shapes that broadcast together), WITHOUT dropping zeros
+def haversine(latitudes1, longitudes1, latitudes2, longitudes2):
+
+    lat1 = np.radians(latitudes1)
+    lon1 = np.radians(longitudes1)
+    lat2 = np.radians(latitudes2)
+    lon2 = np.radians(longitudes2)
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    # Same formula as computed_distance()
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return Radius_of_earth * c
+
+
+# Distance between every pair of stations, computed once from {station id: (latitude, longitude)}
+# There are only a few hundred stations, so trips look their distance up instead of recomputing it
+class StationDistances:
+
+    def __init__(self, coordinates):
+        self.coordinates = dict(coordinates)
+        self.station_ids = list(self.coordinates)
+        self.index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+
+        latitudes = np.array([lat for lat, lon in self.coordinates.values()], dtype=np.float64)
+        longitudes = np.array([lon for lat, lon in self.coordinates.values()], dtype=np.float64)
 
-        # Most used Bike (indicated by Bike ID) from Starting Station
-    starting_station_ID_counter = collections.Counter(
-        [row['Starting Station ID'] for row in rows])
-    # Most used Bike (indicated by Bike ID) from Ending Station
-    ending_station_ID_counter = collections.Counter(
-        [row['Ending Station ID'] for row in rows])
+        # Broadcasting a column against a row gives the full station x station matrix
+        self.matrix = haversine(latitudes[:, None], longitudes[:, None],
+                                latitudes[None, :], longitudes[None, :])
 
-    # Set veriables for graphs in main function passing rows that yields manipulated
-    commuters = plan_duration_and_passholder_type(rows)
-    most_popular_trip_routes = trip_route_data(rows)
+        # A station with an empty coordinate has no usable distance
+        missing = (latitudes == 0) | (longitudes == 0)
+        self.matrix[missing, :] = np.nan
+        self.matrix[:, missing] = np.nan
+
+    def distance(self, start_station_id, end_station_id):
+        return float(self.matrix[self.index[start_station_id], self.index[end_station_id]])
+
+    # pair_counts: {(Starting Station ID, Ending Station ID): number of trips}
+    # Returns (sum of every trip's distance, number of trips) so callers can combine it with other totals
+    def weighted_total(self, pair_counts):
+        if not pair_counts:
+            return 0.0, 0
+
+        starts = [self.index[start] for start, end in pair_counts]
+        ends = [self.index[end] for start, end in pair_counts]
+        counts = np.fromiter(pair_counts.values(), dtype=np.int64, count=len(pair_counts))
+
+        return float((self.matrix[starts, ends] * counts).sum()), int(counts.sum())
+
+
+# The last StationDistances handed out by station_distances()
+_station_distances = None
+
+
+# Reuses the cached distance matrix unless a station was added or moved (ex.: a new data drop)
+def station_distances(coordinates):
+    global _station_distances
+
+    if _station_distances is None or _station_distances.coordinates != coordinates:
+        _station_distances = StationDistances(coordinates)
+
+    return _station_distances
+
+
+def main(filename=TRIP_DATA_CSV, columnar=False, processes=None, profile=None):
+
+    if profile_mode(profile):
+        # Same dictionary, built stage by stage with timings (see Profiling Section)
+        return profiled_main(filename, columnar, processes, profile_mode(profile) == 'cprofile')
+
+    if processes:
+        # Chunks of the csv parsed & aggregated in a pool of worker processes, then merged
+        results = parallel_aggregate(filename, processes)
+    elif columnar:
+        # Same analyses as vectorized NumPy operations over a TripTable
+        results = table_analyses(parse(filename, columnar=True))
+    else:
+        # rows yields all manipulated data, streamed one row at a time so the whole csv never sits in memory
+        rows = parse(filename, stream=True)
+
+        # Every analysis below is an accumulator, so all of them are filled from ONE pass over rows
+        results = aggregate(rows, main_accumulators())
+
+    return main_dictionary(results)
+
+
+# Turns the analyses' results into the dictionary main() returns
+def main_dictionary(results):
+
+    most_popular_trip_routes = results['Most Popular Trip Routes']
 
     # For 'Total Round Trip Trip Routes'
     round_trip_total = sorted(most_popular_trip_routes.items())
@@ -119,18 +775,6 @@ def main():
 
     # oneway_time_intervals = one_way_trip_route_and_duration_data(rows)
 
-    scatterplot = scatterplot_data(rows)
-
-    combinations_for_piechart = combination_data(rows)
-
-    combinations_for_piechart2 = combination_data2(rows)
-
-    combinations_for_piechart3 = combination_data3(rows)
-
-    combinations_for_piechart4 = combination_data4(rows)
-
-    trip_time = average_trip_time_data(rows)
-
 # UNCOMMENT
     # distance = distance_traveled_over_time(rows)
 
@@ -151,17 +795,17 @@ def main():
 
         # Answer for Average Distance is in Kilometers(Km)
         # Answer to Question 1
-        'Average Distance': sum(average_distances_total)/len(average_distances_total),
+        'Average Distance': results['Station Pairs'].average_distance(),
 
         # 'Z': distance,
 
         # "most_common(1)" means return the MOST common or the number 1 recurring Starting Station ID
         # Answer(s) to Question 2
-        'Most Popular Starting Station ID': starting_station_ID_counter.most_common(1),
+        'Most Popular Starting Station ID': results['Most Popular Starting Station ID'],
         # Answer(s) to Question 2
-        'Most Popular Ending Station ID': ending_station_ID_counter.most_common(1),
+        'Most Popular Ending Station ID': results['Most Popular Ending Station ID'],
         # Answer to Question 4
-        'Number of Regular Commuters': commuters,
+        'Number of Regular Commuters': results['Number of Regular Commuters'],
 
         'Most Popular Trip Routes': most_popular_trip_routes,
 
@@ -169,22 +813,541 @@ def main():
 
         'Total One Way Trip Routes': sum(one_way_total),
 
-        'Scatterplot': scatterplot,
+        'Scatterplot': results['Scatterplot'],
+
+        'Pie Chart of Combinations': results['Combinations']['Pie Chart of Combinations'],
 
-        'Pie Chart of Combinations': combinations_for_piechart,
+        '2nd Pie Chart of Combinations': results['Combinations']['2nd Pie Chart of Combinations'],
 
-        '2nd Pie Chart of Combinations': combinations_for_piechart2,
+        '3rd Pie Chart of Combinations': results['Combinations']['3rd Pie Chart of Combinations'],
 
-        '3rd Pie Chart of Combinations': combinations_for_piechart3,
+        '4th Pie Chart of Combinations': results['Combinations']['4th Pie Chart of Combinations'],
 
-        '4th Pie Chart of Combinations': combinations_for_piechart4,
+        'Trip Time': results['Trip Time'],
 
-        'Trip Time': trip_time
+        # Bounded size summary of every trip's Duration (histogram, percentiles, longest trips, exact totals)
+        'Trip Time Summary': results['Trip Time Summary'],
+
+        # Trips per station pair & station coordinates for bike_share_paths_graph()
+        'Bike Share Paths': results['Station Pairs']
 
         # 'Test': dummy_test
     }
 
 
+"""
+Aggregation Engine Section
+
+ Each analysis is an accumulator object with three methods:
+    add(row)      --> folds ONE row into the accumulator; when it skips the row it returns why (ex.: 'weekend')
+    merge(other)  --> folds in another accumulator of the same kind (ex.: one filled from a different csv)
+    result()      --> returns the finished data (same format the matching *_data(rows) function returns)
+ aggregate() feeds every registered accumulator from a single pass over the rows
+"""
+
+
+def aggregate(rows, accumulators):
+    feed(rows, accumulators)
+    return {name: accumulator.result() for name, accumulator in accumulators.items()}
+
+
+def feed(rows, accumulators):
+
+    # Look up each bound add() once so the inner loop does not repeat attribute lookups
+    updates = [accumulator.add for accumulator in accumulators.values()]
+
+    for row in rows:
+        for update in updates:
+            update(row)
+
+    return accumulators
+
+
+# Folds source into target: numbers are added, lists are extended and nested dictionaries are merged key by key
+def merge_counts(target, source):
+    for key, value in source.items():
+        if key not in target:
+            target[key] = copy.deepcopy(value)
+        elif isinstance(value, dict):
+            merge_counts(target[key], value)
+        else:
+            target[key] += value
+    return target
+
+
+# count & sum of a stream of numbers without keeping the numbers themselves
+# extended=True also keeps min, max and the variance (Welford's method, so it stays accurate over millions of values)
+class RunningStats:
+
+    __slots__ = ('extended', 'count', 'total', 'mean', 'm2', 'minimum', 'maximum')
+
+    def __init__(self, extended=False):
+        self.extended = extended
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+
+        if self.extended:
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+
+    def merge(self, other):
+        if not other.count:
+            return
+
+        if self.extended:
+            # Chan et al.'s pairwise update combines two Welford states exactly
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+        self.count += other.count
+        self.total += other.total
+
+    # sum/count, or 0 when nothing was added (so the data is not disturbed)
+    def average(self):
+        return self.total/self.count if self.count else 0
+
+    # Population variance (divide by count); sample=True divides by count - 1
+    def variance(self, sample=False):
+        count = self.count - 1 if sample else self.count
+        return self.m2 / count if count > 0 else 0.0
+
+
+# {key: RunningStats} for per-date / per-ID averages, ex.: average One Way Duration per date
+class GroupedStats:
+
+    def __init__(self, extended=False):
+        self.extended = extended
+        self.stats = {}
+
+    def add(self, key, value):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = RunningStats(self.extended)
+        stats.add(value)
+
+    def merge(self, other):
+        for key, stats in other.stats.items():
+            if key not in self.stats:
+                self.stats[key] = RunningStats(self.extended)
+            self.stats[key].merge(stats)
+
+    def __getitem__(self, key):
+        return self.stats[key]
+
+    def __contains__(self, key):
+        return key in self.stats
+
+    def __len__(self):
+        return len(self.stats)
+
+    def items(self):
+        return self.stats.items()
+
+
+# The accumulators behind main(), keyed by the name main() reports them under
+def main_accumulators():
+    return {
+        'Station Pairs': StationPairs(),
+        'Most Popular Starting Station ID': StationIDCounter('Starting Station ID'),
+        'Most Popular Ending Station ID': StationIDCounter('Ending Station ID'),
+        'Number of Regular Commuters': PlanDurationAndPassholderType(),
+        'Most Popular Trip Routes': TripRouteData(),
+        'Scatterplot': ScatterplotData(),
+        # All four pie charts from one grouped count
+        'Combinations': GroupedCounts(COMBINATIONS),
+        'Trip Time': AverageTripTimeData(),
+        'Trip Time Summary': TripTimeSummary(),
+    }
+
+
+# Trips per (Starting Station ID, Ending Station ID) and the coordinates of every station
+# Its distances come from the cached station x station matrix instead of one computed_distance() per trip
+class StationPairs:
+
+    def __init__(self):
+        # First coordinates seen for each station: {station id: (latitude, longitude)}
+        self.coordinates = {}
+        # Every trip per (Starting Station ID, Ending Station ID)
+        self.trip_counts = collections.Counter()
+        # Trips whose coordinates are filled in and match their stations' coordinates
+        self.distance_counts = collections.Counter()
+        # Trips whose coordinates differ from their station's, measured one by one
+        self.other_total = 0.0
+        self.other_count = 0
+
+    def add(self, row):
+        key = (row['Starting Station ID'], row['Ending Station ID'])
+        self.trip_counts[key] += 1
+
+        start = (row['Starting Station Latitude'], row['Starting Station Longitude'])
+        end = (row['Ending Station Latitude'], row['Ending Station Longitude'])
+
+        # Taking into account potential empty strings that may corrupt data
+        if 0 in start or 0 in end:
+            return 'empty coordinates'
+
+        # setdefault keeps the first coordinates seen for a station
+        start_matches = self.coordinates.setdefault(key[0], start) == start
+        end_matches = self.coordinates.setdefault(key[1], end) == end
+
+        if start_matches and end_matches:
+            self.distance_counts[key] += 1
+        else:
+            self.other_total += computed_distance(*start, *end)
+            self.other_count += 1
+
+    def merge(self, other):
+        self.trip_counts.update(other.trip_counts)
+        self.other_total += other.other_total
+        self.other_count += other.other_count
+
+        for station_id, coordinates in other.coordinates.items():
+            self.coordinates.setdefault(station_id, coordinates)
+
+        for (start, end), count in other.distance_counts.items():
+            start_coordinates = other.coordinates[start]
+            end_coordinates = other.coordinates[end]
+
+            if self.coordinates[start] == start_coordinates and self.coordinates[end] == end_coordinates:
+                self.distance_counts[(start, end)] += count
+            else:
+                # These trips disagree with the coordinates kept here, so they are measured on their own
+                self.other_total += computed_distance(*start_coordinates, *end_coordinates) * count
+                self.other_count += count
+
+    def distances(self):
+        return station_distances(self.coordinates)
+
+    # Average of computed_distance() over every trip with all four coordinates filled in
+    # (NaN when there is no such trip, same as computed_distances())
+    def average_distance(self):
+        total, count = self.distances().weighted_total(self.distance_counts)
+        if not count + self.other_count:
+            return float('nan')
+        return (total + self.other_total) / (count + self.other_count)
+
+    def result(self):
+        return self
+
+
+# Counts how often each Station ID shows up in "column" (Starting Station ID or Ending Station ID)
+class StationIDCounter:
+
+    def __init__(self, column):
+        self.column = column
+        self.counter = collections.Counter()
+
+    def add(self, row):
+        self.counter[row[self.column]] += 1
+
+    def merge(self, other):
+        self.counter.update(other.counter)
+
+    def result(self):
+        # "most_common(1)" means return the MOST common or the number 1 recurring Station ID
+        return self.counter.most_common(1)
+
+
+"""
+Incremental Section
+
+ LA Metro publishes new trips every month/quarter; ingest() folds ONLY the new csv into the saved state
+ Run code in terminal: x = ingest('metro-bike-share-trip-data-2018-q1.csv')
+ Where "x" is the same dictionary main() returns, but covering every csv ingested so far
+"""
+
+# Pickled {'version': STATE_VERSION, 'accumulators': main_accumulators(), 'sources': {sha1 of csv: csv file name}}
+STATE_FILE = 'bike-share-state.pickle'
+# Bump whenever an accumulator's pickled fields change; a state saved under another version has to be rebuilt
+STATE_VERSION = 2
+
+
+def load_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'rb') as saved_state:
+            state = pickle.load(saved_state)
+    except FileNotFoundError:
+        return {'version': STATE_VERSION, 'accumulators': main_accumulators(), 'sources': {}}
+    # Classes renamed, removed or reshaped since the state was saved
+    except (AttributeError, ImportError, KeyError, TypeError, EOFError, pickle.UnpicklingError) as error:
+        raise stale_state(state_file, '{}: {}'.format(type(error).__name__, error)) from error
+
+    version = state.get('version') if isinstance(state, dict) else None
+    if version != STATE_VERSION:
+        raise stale_state(state_file, 'state version {}, expected {}'.format(version, STATE_VERSION))
+
+    # Catches a main_accumulators() change that forgot to bump STATE_VERSION
+    names, expected = set(state['accumulators']), set(main_accumulators())
+    if names != expected:
+        raise stale_state(state_file, 'accumulators {} missing, {} unknown'.format(
+            sorted(expected - names), sorted(names - expected)))
+
+    return state
+
+
+def stale_state(state_file, reason):
+    return ValueError('{} was saved by a different version of script.py ({}); '
+                      'rebuild state: delete it and ingest() every csv again'.format(state_file, reason))
+
+
+def save_state(state, state_file=STATE_FILE):
+    # Written next to the old state then swapped in, so a crash mid-write never loses the history
+    temporary = state_file + '.tmp'
+    with open(temporary, 'wb') as saved_state:
+        pickle.dump(state, saved_state, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, state_file)
+
+
+def ingest(filename=TRIP_DATA_CSV, state_file=STATE_FILE):
+    state = load_state(state_file)
+    sha1 = file_hash(filename)
+
+    # The same csv ingested twice would count its trips twice
+    if sha1 not in state['sources']:
+        new_trips = feed(parse(filename, stream=True), main_accumulators())
+
+        for name, accumulator in state['accumulators'].items():
+            accumulator.merge(new_trips[name])
+
+        state['sources'][sha1] = filename
+        save_state(state, state_file)
+
+    return main_dictionary({name: accumulator.result() for name, accumulator in state['accumulators'].items()})
+
+
+"""
+Parallel Section
+
+ main(processes=32) splits the csv into byte ranges, parses & aggregates each range in a process pool
+ and merges the partial accumulators (same merge() ingest() uses)
+ Note: a range boundary is moved to the next line start, so trip rows must not contain line breaks inside quotes
+"""
+
+
+def parallel_aggregate(filename=TRIP_DATA_CSV, processes=None, chunks=None):
+    processes = processes or os.cpu_count()
+    # A few chunks per process keeps every core busy even when some ranges parse slower than others
+    ranges = byte_ranges(filename, chunks or processes * 4)
+
+    with multiprocessing.Pool(processes) as pool:
+        # imap hands results back in csv order, so ties (ex.: most_common) break the same way as one pass would
+        partials = pool.imap(aggregate_byte_range, [(filename, start, end) for start, end in ranges])
+
+        accumulators = next(partials, None) or main_accumulators()
+        for partial in partials:
+            for name, accumulator in accumulators.items():
+                accumulator.merge(partial[name])
+
+    return {name: accumulator.result() for name, accumulator in accumulators.items()}
+
+
+# [(start, end), ...] byte offsets covering everything after the header line
+def byte_ranges(filename, chunks):
+    with open(filename, 'rb') as csv_file:
+        data_start = len(csv_file.readline())
+    size = os.path.getsize(filename)
+
+    step = max(1, -(-(size - data_start) // chunks))
+    return [(start, min(start + step, size)) for start in range(data_start, size, step)]
+
+
+# Runs in a worker process: main_accumulators() filled with the rows that START inside [start, end)
+def aggregate_byte_range(arguments):
+    filename, start, end = arguments
+
+    with open(filename, 'rb') as csv_file:
+        header = next(csv.reader([csv_file.readline().decode('utf-8')]))
+
+        # Step back one byte and finish that line: the row in progress at "start" belongs to the range before
+        csv_file.seek(start - 1)
+        csv_file.readline()
+
+        lines = byte_range_lines(csv_file, end)
+        rows = (convert_row(row) for row in csv.DictReader(lines, fieldnames=header))
+
+        return feed(rows, main_accumulators())
+
+
+def byte_range_lines(csv_file, end):
+    position = csv_file.tell()
+
+    while position < end:
+        line = csv_file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line.decode('utf-8')
+
+
+"""
+Profiling Section
+
+ x = main(profile=True) (or BIKESHARE_PROFILE=1) runs the same analyses one stage at a time and adds x['Profile']:
+    wall time, rows in, rows skipped (by the reason add() returned) and tracemalloc peak for every stage
+    (csv tokenizing, convert_row, each accumulator, main_dictionary; columnar / parallel runs have coarser stages)
+ The report is also written to bike-share-profile.json
+ profile='cprofile' (or BIKESHARE_PROFILE=cprofile) also dumps the hottest stage's cProfile stats to
+ bike-share-profile.prof, ex.) python -m pstats bike-share-profile.prof
+ tracemalloc (and cProfile) slow every stage down, so compare profiled runs with profiled runs
+"""
+
+PROFILE_REPORT = 'bike-share-profile.json'
+
+# Rows read, converted and fed per stage in a profiled run
+PROFILE_CHUNK_SIZE = 65536
+
+
+# True / 'cprofile' when main() should profile; profile=None leaves it to the BIKESHARE_PROFILE env var
+def profile_mode(profile=None):
+    if profile is None:
+        setting = os.environ.get('BIKESHARE_PROFILE', '')
+        return 'cprofile' if setting == 'cprofile' else setting == '1'
+    return profile
+
+
+class Profiler:
+
+    def __init__(self, cprofile=False):
+        # {stage: {'seconds', 'rows', 'skipped', 'peak_bytes'}} in the order stages first ran
+        self.stages = {}
+        # One cProfile.Profile per stage, switched on only while that stage runs
+        self.profiles = {} if cprofile else None
+
+    # Times one run of a stage; a stage that runs once per chunk adds every run together
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+        stats = self.stages.setdefault(name, {'seconds': 0.0, 'rows': 0, 'skipped': {}, 'peak_bytes': 0})
+        profile = self.profiles.setdefault(name, cProfile.Profile()) if self.profiles is not None else None
+
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        if profile:
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] += time.perf_counter() - start
+            if profile:
+                profile.disable()
+            stats['rows'] += rows
+            stats['peak_bytes'] = max(stats['peak_bytes'], tracemalloc.get_traced_memory()[1] - current)
+
+    def hottest(self):
+        return max(self.stages, key=lambda name: self.stages[name]['seconds'], default=None)
+
+    def report(self, filename, path):
+        stages = [{
+            'stage': name,
+            'seconds': stats['seconds'],
+            'rows': stats['rows'],
+            'rows_per_second': stats['rows'] / stats['seconds'] if stats['seconds'] else None,
+            'skipped': stats['skipped'],
+            'peak_mb': stats['peak_bytes'] / 2**20,
+        } for name, stats in self.stages.items()]
+
+        return {
+            'file': filename,
+            'path': path,
+            'rows': max((stats['rows'] for stats in self.stages.values()), default=0),
+            'seconds': sum(stats['seconds'] for stats in self.stages.values()),
+            'hottest stage': self.hottest(),
+            'stages': stages,
+        }
+
+
+def profiled_main(filename=TRIP_DATA_CSV, columnar=False, processes=None, cprofile=False, report=PROFILE_REPORT):
+    profiler = Profiler(cprofile)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        if processes:
+            # Worker processes are a black box here: one stage, and tracemalloc only sees this process
+            with profiler.stage('parallel_aggregate') as stats:
+                results = parallel_aggregate(filename, processes)
+                stats['rows'] += sum(results['Station Pairs'].trip_counts.values())
+            path = 'parallel'
+        elif columnar:
+            with profiler.stage('load_trip_table') as stats:
+                table = parse(filename, columnar=True)
+                stats['rows'] += len(table)
+            with profiler.stage('table_analyses', len(table)):
+                results = table_analyses(table)
+            path = 'columnar'
+        else:
+            results = profiled_aggregate(filename, profiler)
+            path = 'stream'
+
+        with profiler.stage('main_dictionary'):
+            x = main_dictionary(results)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    x['Profile'] = profiler.report(filename, path)
+
+    if cprofile and profiler.hottest():
+        dump = os.path.splitext(report)[0] + '.prof'
+        profiler.profiles[profiler.hottest()].dump_stats(dump)
+        x['Profile']['cprofile'] = dump
+
+    with open(report, 'w') as report_file:
+        json.dump(x['Profile'], report_file, indent=2)
+
+    return x
+
+
+# aggregate(parse(stream=True), main_accumulators()) split into stages, one chunk of rows at a time
+def profiled_aggregate(filename, profiler, chunk_size=PROFILE_CHUNK_SIZE):
+    accumulators = main_accumulators()
+
+    with open(filename, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+
+        while True:
+            with profiler.stage('csv tokenizing') as stats:
+                chunk = [row for _, row in zip(range(chunk_size), reader)]
+                stats['rows'] += len(chunk)
+            if not chunk:
+                break
+
+            with profiler.stage('convert_row', len(chunk)):
+                chunk = [convert_row(row) for row in chunk]
+
+            for name, accumulator in accumulators.items():
+                with profiler.stage(name, len(chunk)) as stats:
+                    add = accumulator.add
+                    reasons = [add(row) for row in chunk]
+
+                # Counted outside the timed stage; add() returns why it skipped a row (None when it kept it)
+                for reason, count in collections.Counter(reasons).items():
+                    if reason is not None:
+                        stats['skipped'][reason] = stats['skipped'].get(reason, 0) + count
+
+    return {name: accumulator.result() for name, accumulator in accumulators.items()}
+
+
 """
 Parsed data from csv Section
 
@@ -193,352 +1356,1692 @@ Parsed data from csv Section
 
 # Will display number of commuters for monthly pass each day ANd number of commuters for flex passes each day
 def plan_duration_and_passholder_type(rows):
+    return aggregate(rows, {'data': PlanDurationAndPassholderType()})['data']
 
-    # rows yields all manipulated data
-    # rows = parse()
 
-    # Holding Data from plan_duration_and_passholder_type(rows)
-    passholder_types_dates = {}
+class PlanDurationAndPassholderType:
 
-    for row in rows:
+    def __init__(self):
+        # Holding Data from plan_duration_and_passholder_type(rows)
+        self.passholder_types_dates = {}
+
+    def add(self, row):
         if row['Plan Duration'] == 0:
-            continue
+            return 'Plan Duration 0'
         if row['Passholder Type'] == 'Staff Annual':
-            continue
+            return 'Staff Annual'
 
         # Filter out weekends
         date = row['Start Time']
         if date.weekday() == 5 or date.weekday() == 6:
-            continue
+            return 'weekend'
 
         date = date.strftime("%Y-%m-%d")
 
         # The Dates are the KEYS and the dictionary of {'Monthly Pass' and 'Flex Pass'} are the VALUES
 
         # If we encounter a Start Time for the first time, add 1 to Monthly pass or flex pass:
-        if date not in passholder_types_dates:
-            passholder_types_dates[date] = {'Monthly Pass': 0, 'Flex Pass': 0}
-        passholder_types_dates[date][row['Passholder Type']] += 1
+        if date not in self.passholder_types_dates:
+            self.passholder_types_dates[date] = {'Monthly Pass': 0, 'Flex Pass': 0}
+        self.passholder_types_dates[date][row['Passholder Type']] += 1
 
-    return passholder_types_dates
+    def merge(self, other):
+        merge_counts(self.passholder_types_dates, other.passholder_types_dates)
+
+    def result(self):
+        return self.passholder_types_dates
 
 
 # Will display number of Trip Routes for One Ways each day AND number of Trip Routes for Round Trips each day
 def trip_route_data(rows):
+    return aggregate(rows, {'data': TripRouteData()})['data']
 
-    # rows yields all manipulated data
-    # rows = parse()
 
-    trip_route_dates = {}
+class TripRouteData:
 
-    for row in rows:
+    def __init__(self):
+        self.trip_route_dates = {}
+
+    def add(self, row):
 
         # Filter out weekends
         date = row['Start Time']
         if date.weekday() == 5 or date.weekday() == 6:
-            continue
+            return 'weekend'
 
         date = date.strftime("%Y-%m-%d")
 
         # The Dates are the KEYS and the dictionary of {'Round Trip' and 'One Way'} are the VALUES
 
         # If we encounter a Start Time for the first time, add 1 to Round Trip or One Way:
-        if date not in trip_route_dates:
-            trip_route_dates[date] = {'Round Trip': 0, 'One Way': 0}
-        trip_route_dates[date][row['Trip Route Category']] += 1
+        if date not in self.trip_route_dates:
+            self.trip_route_dates[date] = {'Round Trip': 0, 'One Way': 0}
+        self.trip_route_dates[date][row['Trip Route Category']] += 1
+
+    def merge(self, other):
+        merge_counts(self.trip_route_dates, other.trip_route_dates)
+
+    def result(self):
+        return self.trip_route_dates
+
+
+# Most ridden (Starting Station ID, Ending Station ID) routes, overall or per day / Passholder Type
+# Run code in terminal: route_ranking(parse()).top(10) or route_ranking(parse(), 'Passholder Type').top_by_group(5)
+def route_ranking(rows, group=None):
+    return aggregate(rows, {'data': RouteCounts(group)})['data']
+
+
+# Number of routes drawn on the Bike Share Paths map
+TOP_ROUTES = 50
+
 
-    return trip_route_dates
+# Trips per (group, Starting Station ID, Ending Station ID); group is a column name,
+# 'Start Time' groups by day and 'Start Hour' by hour of the day
+class RouteCounts:
+
+    def __init__(self, group=None):
+        self.group = group
+        self.counts = collections.Counter()
+
+    def add(self, row):
+        if self.group is None:
+            group = None
+        elif self.group == 'Start Time':
+            group = row['Start Time'].strftime("%Y-%m-%d")
+        elif self.group == 'Start Hour':
+            group = row['Start Time'].hour
+        else:
+            group = row[self.group]
+
+        self.counts[(group, row['Starting Station ID'], row['Ending Station ID'])] += 1
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+
+    def result(self):
+        groups = {}
+        group_codes, routes = [], []
+        for group, start, end in self.counts:
+            group_codes.append(groups.setdefault(group, len(groups)))
+            routes.append((start, end))
+
+        return RouteRanking(list(groups), np.array(group_codes, dtype=np.int64), routes,
+                            np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts)))
+
+
+# Indices of the k largest counts, biggest first; equal counts keep their order (same as a stable sort)
+def top_k_indices(counts, k):
+    if k >= len(counts):
+        return np.argsort(-counts, kind='stable')
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+
+    # Partial selection: only the k-th largest count is needed to know which entries make the cut
+    threshold = np.partition(counts, len(counts) - k)[len(counts) - k]
+    above = np.flatnonzero(counts > threshold)
+    ties = np.flatnonzero(counts == threshold)[:k - len(above)]
+
+    chosen = np.sort(np.concatenate([above, ties]))
+    return chosen[np.argsort(-counts[chosen], kind='stable')]
+
+
+# Compact route counts: one entry per (group, route), in order of each entry's first trip
+class RouteRanking:
+
+    def __init__(self, groups, group_codes, routes, counts):
+        # Group labels (just [None] when ungrouped) and each entry's index into them
+        self.groups = groups
+        self.group_codes = group_codes
+        # (Starting Station ID, Ending Station ID) and its trips for every entry
+        self.routes = routes
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.routes)
+
+    # [((Starting Station ID, Ending Station ID), trips), ...] for the k most ridden routes of one group
+    # (every group added together when group is None)
+    def top(self, k=TOP_ROUTES, group=None):
+        if group is None and self.groups != [None]:
+            return self.overall().top(k)
+
+        entries = np.flatnonzero(self.group_codes == self.groups.index(group)) if group in self.groups \
+            else np.array([], dtype=np.int64)
+        chosen = entries[top_k_indices(self.counts[entries], k)]
+        return [(self.routes[i], int(self.counts[i])) for i in chosen.tolist()]
+
+    # {group: top(k, group)} for every group
+    def top_by_group(self, k=TOP_ROUTES):
+        return {group: self.top(k, group) for group in self.groups}
+
+    # The same ranking with the groups added together
+    def overall(self):
+        totals = collections.Counter()
+        for route, count in zip(self.routes, self.counts.tolist()):
+            totals[route] += count
+        return RouteRanking([None], np.zeros(len(totals), dtype=np.int64), list(totals),
+                            np.fromiter(totals.values(), dtype=np.int64, count=len(totals)))
+
+
+# Station-to-station flows; by=None, 'Start Hour' (one slice per hour of the day) or 'Start Time' (one per day)
+# Run code in terminal: od = od_matrix(parse(), 'Start Hour'); od.net_flow(range(7, 10))
+def od_matrix(rows, by=None):
+    return ODMatrix(route_ranking(rows, by))
+
+
+# Origin-destination matrix over dense station indices, kept as (slice, start, end, trips) entries;
+# the n x n matrix and the row / column sums are built only for the slices asked for
+class ODMatrix:
+
+    def __init__(self, ranking):
+        self.station_ids = sorted({station_id for route in ranking.routes for station_id in route})
+        self.index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+
+        # Hours / dates in order ([None] when not sliced)
+        self.slices = sorted(ranking.groups, key=lambda label: (label is not None, label))
+        slice_order = np.array([self.slices.index(label) for label in ranking.groups], dtype=np.int64)
+
+        self.slice_codes = slice_order[ranking.group_codes] if len(ranking) else ranking.group_codes
+        self.starts = np.array([self.index[start] for start, end in ranking.routes], dtype=np.int64)
+        self.ends = np.array([self.index[end] for start, end in ranking.routes], dtype=np.int64)
+        self.counts = ranking.counts
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    # Slices between first and last (inclusive), ex.: od.between('2016-08-01', '2016-08-31')
+    def between(self, first, last):
+        return [label for label in self.slices if first <= label <= last]
+
+    # Entries in the given slices: None for all, one hour / date, or a list of them
+    def selected(self, slices):
+        if slices is None:
+            return slice(None)
+        if isinstance(slices, (str, int)):
+            slices = [slices]
+        codes = [self.slices.index(label) for label in slices if label in self.slices]
+        return np.isin(self.slice_codes, codes)
+
+    # n x n trips, rows are Starting Station IDs and columns are Ending Station IDs (order of station_ids)
+    def matrix(self, slices=None):
+        entries = self.selected(slices)
+        stations = len(self.station_ids)
+        cells = self.starts[entries] * stations + self.ends[entries]
+        return np.bincount(cells, weights=self.counts[entries],
+                           minlength=stations * stations).astype(np.int64).reshape(stations, stations)
+
+    # slices x n x n trips, one matrix per slice
+    def dense(self):
+        stations = len(self.station_ids)
+        cells = (self.slice_codes * stations + self.starts) * stations + self.ends
+        return np.bincount(cells, weights=self.counts, minlength=len(self.slices) * stations * stations) \
+            .astype(np.int64).reshape(len(self.slices), stations, stations)
+
+    # Trips leaving each station (row sums)
+    def outflow(self, slices=None):
+        entries = self.selected(slices)
+        return np.bincount(self.starts[entries], weights=self.counts[entries],
+                           minlength=len(self.station_ids)).astype(np.int64)
+
+    # Trips arriving at each station (column sums)
+    def inflow(self, slices=None):
+        entries = self.selected(slices)
+        return np.bincount(self.ends[entries], weights=self.counts[entries],
+                           minlength=len(self.station_ids)).astype(np.int64)
+
+    # Arrivals minus departures: positive stations gain bikes, negative ones need restocking
+    def net_flow(self, slices=None):
+        return self.inflow(slices) - self.outflow(slices)
+
+    # Trips from one station to another
+    def flow(self, start_station_id, end_station_id, slices=None):
+        entries = self.selected(slices)
+        matches = (self.starts[entries] == self.index.get(start_station_id, -1)) \
+            & (self.ends[entries] == self.index.get(end_station_id, -1))
+        return int(self.counts[entries][matches].sum())
+
+    # [(station id, net flow), ...] from most bikes lost to most bikes gained
+    def imbalance(self, slices=None):
+        net_flow = self.net_flow(slices)
+        return [(self.station_ids[i], int(net_flow[i])) for i in np.argsort(net_flow, kind='stable').tolist()]
+
+
+# Departures & arrivals of every station per 15 / 60 minute bucket, for rebalancing signals
+# Run code in terminal: ts = station_time_series(parse(), 15); ts.peaks('3069', minutes=120)
+def station_time_series(rows, bucket_minutes=60):
+    return aggregate(rows, {'data': StationBucketCounts(bucket_minutes)})['data']
+
+
+# Start of the bucket numbering (bucket 0 starts here)
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+class StationBucketCounts:
+
+    def __init__(self, bucket_minutes=60):
+        self.bucket_minutes = bucket_minutes
+        self.bucket = dt.timedelta(minutes=bucket_minutes)
+        # Trips per (Station ID, bucket number)
+        self.departures = collections.Counter()
+        self.arrivals = collections.Counter()
+
+    def add(self, row):
+        self.departures[(row['Starting Station ID'], (row['Start Time'] - EPOCH) // self.bucket)] += 1
+        self.arrivals[(row['Ending Station ID'], (row['End Time'] - EPOCH) // self.bucket)] += 1
+
+    def merge(self, other):
+        self.departures.update(other.departures)
+        self.arrivals.update(other.arrivals)
+
+    def result(self):
+        station_ids = sorted({station_id for station_id, bucket in self.departures}
+                             | {station_id for station_id, bucket in self.arrivals})
+        index = {station_id: i for i, station_id in enumerate(station_ids)}
+        buckets = [bucket for station_id, bucket in self.departures] + [bucket for station_id, bucket in self.arrivals]
+        first = min(buckets, default=0)
+        size = max(buckets, default=first - 1) - first + 1
+
+        arrays = []
+        for counter in (self.departures, self.arrivals):
+            counts = np.zeros((len(station_ids), size), dtype=np.int32)
+            for (station_id, bucket), trips in counter.items():
+                counts[index[station_id], bucket - first] = trips
+            arrays.append(counts)
+
+        return StationTimeSeries(station_ids, first, self.bucket_minutes, *arrays)
+
+
+# stations x buckets arrays of departures and arrivals; column 0 is bucket number "first" after EPOCH
+class StationTimeSeries:
+
+    def __init__(self, station_ids, first, bucket_minutes, departures, arrivals):
+        self.station_ids = station_ids
+        self.index = {station_id: i for i, station_id in enumerate(station_ids)}
+        self.first = first
+        self.bucket_minutes = bucket_minutes
+        self.departures = departures
+        self.arrivals = arrivals
+
+    # Start time (datetime64[m]) of every bucket
+    def times(self):
+        return (np.datetime64(EPOCH, 'm') + (self.first + np.arange(self.departures.shape[1]))
+                * np.timedelta64(self.bucket_minutes, 'm'))
+
+    # 'departures', 'arrivals' or 'net' (arrivals minus departures: positive stations gain bikes)
+    def counts(self, kind='net'):
+        if kind == 'departures':
+            return self.departures
+        if kind == 'arrivals':
+            return self.arrivals
+        if kind == 'net':
+            return self.arrivals.astype(np.int64) - self.departures
+        raise ValueError('kind must be departures, arrivals or net, not {!r}'.format(kind))
+
+    # One station's buckets
+    def station(self, station_id, kind='net'):
+        return self.counts(kind)[self.index[station_id]]
+
+    # Trips in the "minutes" ending with each bucket (a rolling window, at least one bucket wide)
+    def rolling(self, minutes, kind='net'):
+        counts = self.counts(kind)
+        window = max(1, minutes // self.bucket_minutes)
+
+        totals = np.zeros((counts.shape[0], counts.shape[1] + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=totals[:, 1:])
+        ends = np.arange(1, counts.shape[1] + 1)
+        return totals[:, ends] - totals[:, np.maximum(ends - window, 0)]
+
+    # [(window start, trips), ...] for a station's "top" busiest windows (largest=False: most negative first);
+    # without a station_id --> {station id: peaks} for every station
+    def peaks(self, station_id=None, minutes=None, kind='departures', top=5, largest=True):
+        totals = self.rolling(minutes or self.bucket_minutes, kind)
+        window = max(1, (minutes or self.bucket_minutes) // self.bucket_minutes)
+        starts = self.times() - (window - 1) * np.timedelta64(self.bucket_minutes, 'm')
+
+        def station_peaks(i):
+            chosen = top_k_indices(totals[i] if largest else -totals[i], top)
+            return list(zip(starts[chosen].tolist(), totals[i, chosen].tolist()))
+
+        if station_id is not None:
+            return station_peaks(self.index[station_id])
+        return {station_id: station_peaks(i) for i, station_id in enumerate(self.station_ids)}
+
+
+# Trips, ride time, distance, last station and idle gaps of every bike (Bike ID), for fleet maintenance
+# Run code in terminal: bikes = bike_utilization(parse()); bikes.top(10, 'distance_km'); bikes.bike('6468')
+def bike_utilization(rows):
+    return table_bike_utilization(TripTable.from_rows(rows))
+
+
+# One entry per bike, every field an array in the order of bike_ids
+class BikeUtilization:
+
+    def __init__(self, bike_ids, trips, ride_seconds, distance_km, idle_seconds, longest_idle_seconds,
+                 first_start, last_end, last_station):
+        self.bike_ids = bike_ids
+        self.index = {bike_id: i for i, bike_id in enumerate(bike_ids)}
+        self.trips = trips
+        self.ride_seconds = ride_seconds
+        # Station to station distance of each trip (round trips & stations without coordinates count 0 km)
+        self.distance_km = distance_km
+        # Time parked between the end of one trip and the start of the bike's next trip
+        self.idle_seconds = idle_seconds
+        self.longest_idle_seconds = longest_idle_seconds
+        self.first_start = first_start
+        self.last_end = last_end
+        # Ending Station ID of each bike's latest trip
+        self.last_station = last_station
+
+    def __len__(self):
+        return len(self.bike_ids)
+
+    def bike(self, bike_id):
+        i = self.index[bike_id]
+        return {
+            'Trips': int(self.trips[i]),
+            'Ride Time(Hours)': int(self.ride_seconds[i]) / 3600,
+            'Distance(Km)': float(self.distance_km[i]),
+            'Idle Time(Hours)': int(self.idle_seconds[i]) / 3600,
+            'Longest Idle(Hours)': int(self.longest_idle_seconds[i]) / 3600,
+            'First Trip': self.first_start[i].tolist(),
+            'Last Trip End': self.last_end[i].tolist(),
+            'Last Seen Station': self.last_station[i],
+        }
+
+    # [(Bike ID, value), ...] for the k bikes with the most trips / ride_seconds / distance_km / idle_seconds
+    def top(self, k=10, by='trips'):
+        values = getattr(self, by)
+        return [(self.bike_ids[i], values[i].item()) for i in top_k_indices(values, k).tolist()]
+
+    # Seconds since each bike's last trip ended, as of "when" (a datetime)
+    def idle_since(self, when):
+        return (np.datetime64(when, 's') - self.last_end).astype(np.int64)
+
+    # Bikes over either limit, ex.: due_for_service(ride_hours=200, km=500)
+    def due_for_service(self, ride_hours=None, km=None):
+        due = np.zeros(len(self.bike_ids), dtype=bool)
+        if ride_hours is not None:
+            due |= self.ride_seconds >= ride_hours * 3600
+        if km is not None:
+            due |= self.distance_km >= km
+        return [self.bike_ids[i] for i in np.flatnonzero(due).tolist()]
 
 
 def scatterplot_data(rows):
+    return aggregate(rows, {'data': ScatterplotData()})['data']
 
-    scatterplot_dictionary = {}
 
-    for row in rows:
+class ScatterplotData:
 
-            # Ignore non-existant values
+    def __init__(self):
+        # Running count & sum of the One Way Durations per date (no list of every trip)
+        self.durations = GroupedStats()
+
+    def add(self, row):
+
+        # Ignore non-existant values
         duration = row['Duration']
         if duration == 0:
-            continue
-            # We only want "One Way" data
+            return 'Duration 0'
+        # We only want "One Way" data
         if row['Trip Route Category'] == "Round Trip":
-            continue
-            # Filter out weekends
+            return 'Round Trip'
+        # Filter out weekends
         date = row['Start Time']
         if date.weekday() == 5 or date.weekday() == 6:
-            continue
+            return 'weekend'
 
-        date = date.strftime("%Y-%m-%d")
+        self.durations.add(date.strftime("%Y-%m-%d"), duration)
 
-        # The Duration are the KEYS and the dictionary of {'One Way'} are the VALUES
+    def merge(self, other):
+        self.durations.merge(other.durations)
 
-        # If we encounter a Start Time for the first time, add 1 to Round Trip or One Way:
-        if date not in scatterplot_dictionary:
+    def result(self):
+        scatterplot_dictionary = {}
 
-            # You create a new key\value pair on a dictionary by assigning a value to that key. If the key doesn't exist, it's added and points to that value. If it exists, the current value it points to is overwritten.
-            scatterplot_dictionary[date] = {'One Way': 0, 'Duration': []}
-        scatterplot_dictionary[date][row['Trip Route Category']] += 1
-        # scatterplot_dictionary[duration] = scatterplot_dictionary[date]
-        scatterplot_dictionary[date]['Duration'].append(row['Duration'])
+        for dates, stats in self.durations.items():
+            # 'One Way' is the number of One Way trips that day, 'Duration' their average
+            # Divide by 60 to convert minutes from seconds
+            scatterplot_dictionary[dates] = {'One Way': stats.count, 'Duration': stats.average() / 60}
 
-    for dates in scatterplot_dictionary:
-        # temp is to access the value of 'Duration'
-        temp = scatterplot_dictionary[dates]['Duration']
+        # scatterplot_dictionary format: {dates {One Way: value, Duration: value} }
+        # The value(s) of "dates" is the inner dictionary
+        return scatterplot_dictionary
 
-        if temp:
-            # Divide by 60 to convert minutes from seconds
-            scatterplot_dictionary[dates]['Duration'] = (
-                sum(temp)/len(temp)) / 60
-        else:
-            # If am excel box is blank set equal to 0 so the data is not disturbed
-            scatterplot_dictionary[dates]['Duration'] = 0
 
-    # scatterplot_dictionary format: {dates {One Way: value, Duration: value} }
-    # The value(s) of "dates" is the inner dictionary
-    return scatterplot_dictionary
+# Keeps trips that have a Plan Duration (the csv leaves it empty for some, which parse() turns into -1)
+# Works on ONE row (--> True/False) and on a whole TripTable (--> NumPy mask)
+def has_plan_duration(trips):
+    return trips['Plan Duration'] != -1
+
+
+# main()'s pie charts: {name: ([key columns], filter or None)}
+COMBINATIONS = {
+    'Pie Chart of Combinations': (['Trip Route Category', 'Passholder Type'], None),
+    '2nd Pie Chart of Combinations': (['Trip Route Category', 'Passholder Type', 'Plan Duration'], has_plan_duration),
+    '3rd Pie Chart of Combinations': (['Passholder Type', 'Plan Duration'], has_plan_duration),
+    '4th Pie Chart of Combinations': (['Trip Route Category', 'Plan Duration'], has_plan_duration),
+}
+
+# How a key value is written out (columns not listed here are shown as they are)
+LABEL_FORMATS = {
+    'Plan Duration': "Plan Duration - {} day(s)".format,
+}
+
+
+def format_label(column, value):
+    return LABEL_FORMATS[column](value) if column in LABEL_FORMATS else value
 
 
 def combination_data(rows):
+    return grouped_counts(rows, {'data': COMBINATIONS['Pie Chart of Combinations']})['data']
 
-    combinations_dictionary = {}
 
-    for row in rows:
+def combination_data2(rows):
+    return grouped_counts(rows, {'data': COMBINATIONS['2nd Pie Chart of Combinations']})['data']
 
-        # Creates a tuple that counts the number of each occuring combination of all possbillities
-        key = (row['Trip Route Category'], row['Passholder Type'])
 
-        if key not in combinations_dictionary:
-            combinations_dictionary[key] = 0
+def combination_data3(rows):
+    return grouped_counts(rows, {'data': COMBINATIONS['3rd Pie Chart of Combinations']})['data']
 
-        combinations_dictionary[key] += 1
 
-    return combinations_dictionary
+def combination_data4(rows):
+    return grouped_counts(rows, {'data': COMBINATIONS['4th Pie Chart of Combinations']})['data']
 
 
-def combination_data2(rows):
+# Any number of groupings counted in ONE pass: grouped_counts(rows, {name: ([key columns], filter or None)})
+# Ex.) grouped_counts(parse(stream=True), {'Bikes per Route': (['Trip Route Category', 'Bike ID'], None)})
+# Filters should be module level functions so the accumulator can be pickled (ingest() & main(processes=...))
+def grouped_counts(rows, groupings):
+    return aggregate(rows, {'data': GroupedCounts(groupings)})['data']
 
-    combinations_dictionary2 = {}
 
-    for row in rows:
+class GroupedCounts:
 
-        # Creates a tuple that counts the number of each occuring combination of all possbillities
-        key = (row['Trip Route Category'], row['Passholder Type'],
-               "Plan Duration - {} day(s)".format(row['Plan Duration']))
+    def __init__(self, groupings):
+        # (name, key columns, a function pulling those columns out of a row as one tuple, filter, counts)
+        self.groupings = [
+            (name, columns, row_key(columns), where, collections.Counter())
+            for name, (columns, where) in groupings.items()
+        ]
 
-        if row['Plan Duration'] == -1:
-            continue
+    def add(self, row):
+        # Raw values are counted; labels are only formatted in result(), once per combination
+        skipped = None
+        for name, columns, key, where, counts in self.groupings:
+            if where is None or where(row):
+                counts[key(row)] += 1
+            elif skipped is None:
+                skipped = 'not ' + where.__name__
+        return skipped
 
-        if key not in combinations_dictionary2:
-            combinations_dictionary2[key] = 0
+    def merge(self, other):
+        for (_, _, _, _, counts), (_, _, _, _, other_counts) in zip(self.groupings, other.groupings):
+            counts.update(other_counts)
 
-        combinations_dictionary2[key] += 1
+    def result(self):
+        results = {}
+        for name, columns, key, where, counts in self.groupings:
+            labelled = results[name] = {}
+            for values, count in counts.items():
+                label = tuple([format_label(column, value) for column, value in zip(columns, values)])
+                labelled[label] = labelled.get(label, 0) + count
+        return results
 
-    return combinations_dictionary2
 
+# row --> tuple of the row's values in "columns" (operator.itemgetter only makes a tuple for 2+ columns)
+# Both kinds of key pickle, so GroupedCounts still works with ingest() & main(processes=...)
+def row_key(columns):
+    if len(columns) == 1:
+        return SingleColumnKey(columns[0])
+    return operator.itemgetter(*columns)
 
-def combination_data3(rows):
 
-    combinations_dictionary3 = {}
+class SingleColumnKey:
 
-    for row in rows:
+    def __init__(self, column):
+        self.column = column
 
-        # Creates a tuple that counts the number of each occuring combination of all possbillities
-        key = (row['Passholder Type'],
-               "Plan Duration - {} day(s)".format(row['Plan Duration']))
+    def __call__(self, row):
+        return (row[self.column],)
 
-        if row['Plan Duration'] == -1:
-            continue
 
-        if key not in combinations_dictionary3:
-            combinations_dictionary3[key] = 0
+def average_trip_time_data(rows):
+    return aggregate(rows, {'data': AverageTripTimeData()})['data']
 
-        combinations_dictionary3[key] += 1
 
-    return combinations_dictionary3
+class AverageTripTimeData:
 
+    def __init__(self):
+        # Running count & sum of the Durations per Trip ID
+        self.durations = GroupedStats()
+        # (Trip IDs, Duration totals, counts) handed over by merge() or unpickling, in csv order
+        self.parts = []
 
-def combination_data4(rows):
+    def add(self, row):
 
-    combinations_dictionary4 = {}
+        trip_id = row['Trip ID']
+        if trip_id == 0:
+            return 'Trip ID 0'
+
+        self.durations.add(trip_id, row['Duration'])
+
+    def merge(self, other):
+        # Trip IDs are unique per trip, so partials are concatenated instead of merged key by key
+        self.parts.append(other.arrays())
+        self.parts.extend(other.parts)
+
+    def arrays(self):
+        stats = self.durations.stats
+        return (list(stats),
+                np.fromiter((stat.total for stat in stats.values()), dtype=np.int64, count=len(stats)),
+                np.fromiter((stat.count for stat in stats.values()), dtype=np.int64, count=len(stats)))
+
+    # Pickle (ex.: parallel workers, ingest state) as three arrays rather than one RunningStats per Trip ID
+    def __getstate__(self):
+        return {'parts': [self.arrays()] + self.parts}
+
+    def __setstate__(self, state):
+        self.durations = GroupedStats()
+        self.parts = state['parts']
+
+    def result(self):
+        parts = [self.arrays()] + self.parts
+        trip_ids = [trip_id for ids, _, _ in parts for trip_id in ids]
+        totals = np.concatenate([part_totals for _, part_totals, _ in parts]).tolist()
+        counts = np.concatenate([part_counts for _, _, part_counts in parts]).tolist()
+
+        # A Trip ID seen in more than one partial (ex.: the same file ingested twice) adds up like merge() used to
+        if len(set(trip_ids)) < len(trip_ids):
+            grouped = {}
+            for trip_id, total, count in zip(trip_ids, totals, counts):
+                previous_total, previous_count = grouped.get(trip_id, (0, 0))
+                grouped[trip_id] = (previous_total + total, previous_count + count)
+            trip_ids = list(grouped)
+            totals, counts = zip(*grouped.values()) if grouped else ((), ())
+
+        # Divide by 60 to convert minutes from seconds
+        return {trip_id: {'Duration': (total / count) / 60} for trip_id, total, count in zip(trip_ids, totals, counts)}
+
+
+# The per Trip ID table grows with every trip; this keeps the same information at a bounded size:
+#   exact totals (count, average, min, max, standard deviation) over ALL trips,
+#   a Duration histogram, Duration percentiles per hour of day and per day (accurate to the histogram's bin width),
+#   and the "top" longest trips
+class TripTimeSummary:
+
+    def __init__(self, bin_minutes=1, max_minutes=1440, top=20):
+        self.bin_minutes = bin_minutes
+        # Trips longer than max_minutes share the last bin
+        self.bins = max_minutes // bin_minutes + 1
+        self.top = top
+
+        self.totals = RunningStats(extended=True)
+        self.histogram = collections.Counter()
+        self.hours = collections.defaultdict(collections.Counter)
+        # Keyed by date; turned into "%Y-%m-%d" strings only in result()
+        self.days = collections.defaultdict(collections.Counter)
+        # Min-heap of (Duration, Trip ID, Start Time) holding the "top" longest trips, Start Time still a datetime
+        self.longest = []
+
+    def add(self, row):
+        duration = row['Duration']
+        start_time = row['Start Time']
+
+        self.totals.add(duration)
+
+        duration_bin = min(duration // 60 // self.bin_minutes, self.bins - 1)
+        self.histogram[duration_bin] += 1
+        self.hours[start_time.hour][duration_bin] += 1
+        self.days[start_time.date()][duration_bin] += 1
+
+        # Almost every trip is shorter than the heap's shortest, so the tuple is only built for real candidates
+        if len(self.longest) < self.top or duration >= self.longest[0][0]:
+            self.keep_if_longest((duration, row['Trip ID'], start_time))
+
+    def keep_if_longest(self, trip):
+        if len(self.longest) < self.top:
+            heapq.heappush(self.longest, trip)
+        elif trip > self.longest[0]:
+            heapq.heapreplace(self.longest, trip)
+
+    def merge(self, other):
+        self.totals.merge(other.totals)
+        self.histogram.update(other.histogram)
+        for hour, histogram in other.hours.items():
+            self.hours[hour].update(histogram)
+        for date, histogram in other.days.items():
+            self.days[date].update(histogram)
+        for trip in other.longest:
+            self.keep_if_longest(trip)
+
+    def dense(self, histogram):
+        counts = np.zeros(self.bins, dtype=np.int64)
+        counts[list(histogram)] = list(histogram.values())
+        return counts
+
+    def result(self):
+        return trip_time_summary(
+            self.totals.count, self.totals.total, self.totals.minimum, self.totals.maximum, self.totals.variance(),
+            self.dense(self.histogram),
+            {hour: self.dense(histogram) for hour, histogram in sorted(self.hours.items())},
+            {date.strftime("%Y-%m-%d"): self.dense(histogram) for date, histogram in sorted(self.days.items())},
+            [(duration, trip_id, start_time.strftime(TIME_FORMAT))
+             for duration, trip_id, start_time in sorted(self.longest, reverse=True)],
+            self.bin_minutes)
+
+
+# Percentiles reported by the Trip Time Summary
+PERCENTILES = [50, 90, 99]
+
+
+# Nearest-rank percentiles of a histogram (counts per bin), as the middle of the bin they fall in (minutes)
+def histogram_percentiles(counts, bin_minutes):
+    cumulative = np.cumsum(counts)
+    percentiles = {}
+
+    for percentile in PERCENTILES:
+        rank = max(1, int(np.ceil(percentile / 100 * cumulative[-1])))
+        percentiles['{}%'.format(percentile)] = (int(np.searchsorted(cumulative, rank)) + 0.5) * bin_minutes
+
+    return percentiles
+
+
+# Builds the Trip Time Summary dictionary (shared by TripTimeSummary and table_trip_time_summary())
+# longest: [(Duration, Trip ID, Start Time), ...] longest first
+def trip_time_summary(count, total, minimum, maximum, variance, histogram, hours, days, longest, bin_minutes):
+    if not count:
+        return {'Trips': 0}
+
+    # Divide by 60 to convert minutes from seconds
+    return {
+        'Trips': count,
+        'Average Duration(Minutes)': (total/count) / 60,
+        'Shortest(Minutes)': minimum / 60,
+        'Longest(Minutes)': maximum / 60,
+        'Standard Deviation(Minutes)': float(np.sqrt(variance)) / 60,
+
+        # {first minute of the bin: trips}
+        'Histogram': {
+            duration_bin * bin_minutes: trips
+            for duration_bin, trips in enumerate(histogram.tolist()) if trips
+        },
+
+        'Percentiles by Hour': {hour: histogram_percentiles(counts, bin_minutes) for hour, counts in hours.items()},
+
+        'Percentiles by Day': {date: histogram_percentiles(counts, bin_minutes) for date, counts in days.items()},
+
+        'Longest Trips': [
+            {'Trip ID': trip_id, 'Duration(Minutes)': duration / 60, 'Start Time': start_time}
+            for duration, trip_id, start_time in longest
+        ],
+    }
 
-    for row in rows:
 
-        # Creates a tuple that counts the number of each occuring combination of all possbillities
-        key = (row['Trip Route Category'],
-               "Plan Duration - {} day(s)".format(row['Plan Duration']))
+"""
+Columnar Analyses Section
+
+ Same data as main_accumulators(), computed with array operations over a TripTable
+ Used by main(columnar=True)
+"""
 
-        if row['Plan Duration'] == -1:
-            continue
 
-        if key not in combinations_dictionary4:
-            combinations_dictionary4[key] = 0
+def table_analyses(table):
 
-        combinations_dictionary4[key] += 1
+    start_days = table['Start Time'].astype('datetime64[D]')
+    # 1970-01-01 was a Thursday, so shifting the day number by 3 matches date.weekday() (Monday == 0)
+    weekdays = (start_days.astype(np.int64) + 3) % 7
+    # Filter out weekends
+    is_weekday = weekdays < 5
 
-    return combinations_dictionary4
+    passholder_types = table['Passholder Type']
+    trip_routes = table['Trip Route Category']
+    plan_durations = table['Plan Duration']
 
+    return {
+        'Station Pairs': table_station_pairs(table),
 
-def average_trip_time_data(rows):
+        'Most Popular Starting Station ID': table_most_common(table, 'Starting Station ID'),
 
-    avg_trip_time_dictionary = {}
+        'Most Popular Ending Station ID': table_most_common(table, 'Ending Station ID'),
 
-    for row in rows:
+        'Number of Regular Commuters': table_per_date_counts(
+            table, start_days, 'Passholder Type',
+            (plan_durations != 0)
+            & (passholder_types != table.code('Passholder Type', 'Staff Annual'))
+            & is_weekday,
+            {'Monthly Pass': 0, 'Flex Pass': 0}),
 
-        trip_id = row['Trip ID']
-        if trip_id == 0:
-            continue
+        'Most Popular Trip Routes': table_per_date_counts(
+            table, start_days, 'Trip Route Category', is_weekday,
+            {'Round Trip': 0, 'One Way': 0}),
 
-        # The Duration are the KEYS and the dictionary of {'One Way'} are the VALUES
+        'Scatterplot': table_scatterplot(
+            table, start_days,
+            (table['Duration'] != 0)
+            & (trip_routes != table.code('Trip Route Category', 'Round Trip'))
+            & is_weekday),
 
-        # If we encounter a Start Time for the first time, add 1 to Round Trip or One Way:
-        if trip_id not in avg_trip_time_dictionary:
+        'Combinations': table_grouped_counts(table, COMBINATIONS),
+
+        'Trip Time': table_average_trip_time(table),
 
-            # You create a new key\value pair on a dictionary by assigning a value to that key. If the key doesn't exist, it's added and points to that value. If it exists, the current value it points to is overwritten.
-            avg_trip_time_dictionary[trip_id] = {'Duration': []}
-        # avg_trip_time_dictionary[duration] = avg_trip_time_dictionary[date]
-        avg_trip_time_dictionary[trip_id]['Duration'].append(row['Duration'])
+        'Trip Time Summary': table_trip_time_summary(table),
+    }
 
-    for trip_ids in avg_trip_time_dictionary:
-        # temp is to access the value of 'Duration'
-        temp = avg_trip_time_dictionary[trip_ids]['Duration']
 
-        if temp:
-            # Divide by 60 to convert minutes from seconds
-            avg_trip_time_dictionary[trip_ids]['Duration'] = (sum(temp)/len(temp)) / 60
+# Same StationPairs the accumulator fills, with the station pairs counted by np.unique
+def table_station_pairs(table):
+    station_pairs = StationPairs()
+    station_ids = table.categories('Starting Station ID')
+    all_starts = table['Starting Station ID']
+    all_ends = table['Ending Station ID']
+
+    stations = len(station_ids)
+
+    # Every trip per pair, in order of each pair's first trip (the order the accumulator sees them in)
+    # A pair is one int64 key (start * stations + end), far cheaper to np.unique than stacked rows
+    pairs, first_trip, counts = np.unique(all_starts.astype(np.int64) * stations + all_ends,
+                                          return_index=True, return_counts=True)
+    order = np.argsort(first_trip, kind='stable')
+    starts, ends = np.divmod(pairs[order], stations)
+    station_pairs.trip_counts.update({
+        (station_ids[start], station_ids[end]): trips
+        for start, end, trips in zip(starts.tolist(), ends.tolist(), counts[order].tolist())
+    })
+
+    latitude1, longitude1, latitude2, longitude2 = [table[column] for column in COORDINATE_COLUMNS]
+
+    # Taking into account potential empty strings that may corrupt data
+    filled = (latitude1 != 0) & (longitude1 != 0) & (latitude2 != 0) & (longitude2 != 0)
+
+    starts = all_starts[filled]
+    ends = all_ends[filled]
+    start_coordinates = np.stack([latitude1[filled], longitude1[filled]], axis=1)
+    end_coordinates = np.stack([latitude2[filled], longitude2[filled]], axis=1)
+
+    # First coordinates seen for each station, reading start then end station of each trip in order
+    station_codes = np.stack([starts, ends], axis=1).ravel()
+    coordinates = np.stack([start_coordinates, end_coordinates], axis=1).reshape(-1, 2)
+    codes, first_seen = np.unique(station_codes, return_index=True)
+
+    station_coordinates = np.zeros((len(station_ids), 2))
+    station_coordinates[codes] = coordinates[first_seen]
+
+    for code in codes[np.argsort(first_seen, kind='stable')].tolist():
+        station_pairs.coordinates[station_ids[code]] = tuple(station_coordinates[code].tolist())
+
+    # Trips whose coordinates differ from their station's are measured one by one
+    matches = ((start_coordinates == station_coordinates[starts]).all(axis=1)
+               & (end_coordinates == station_coordinates[ends]).all(axis=1))
+    others, _ = computed_distances(*start_coordinates[~matches].T, *end_coordinates[~matches].T)
+    station_pairs.other_total = float(others.sum())
+    station_pairs.other_count = len(others)
+
+    pairs, counts = np.unique(starts[matches].astype(np.int64) * stations + ends[matches], return_counts=True)
+    starts, ends = np.divmod(pairs, stations)
+    station_pairs.distance_counts.update({
+        (station_ids[start], station_ids[end]): trips
+        for start, end, trips in zip(starts.tolist(), ends.tolist(), counts.tolist())
+    })
+
+    return station_pairs
+
+
+# Same RouteRanking as route_ranking(rows, group), from the table's station codes
+def table_route_ranking(table, group=None):
+    station_ids = table.categories('Starting Station ID')
+    stations = len(station_ids)
+
+    if group is None:
+        groups, group_codes = [None], np.zeros(len(table), dtype=np.int64)
+    elif group == 'Start Time':
+        days, group_codes = np.unique(table['Start Time'].astype('datetime64[D]'), return_inverse=True)
+        groups = np.datetime_as_string(days).tolist()
+    elif group == 'Start Hour':
+        groups = list(range(24))
+        group_codes = table['Start Time'].astype('datetime64[h]').astype(np.int64) % 24
+    elif group in CATEGORICAL_COLUMNS:
+        groups, group_codes = table.categories(group), table[group].astype(np.int64)
+    else:
+        values, group_codes = np.unique(table[group], return_inverse=True)
+        groups = values.tolist()
+
+    # One int64 key per (group, start, end), counted in order of each key's first trip
+    keys = ((group_codes.reshape(-1) * stations + table['Starting Station ID']) * stations
+            + table['Ending Station ID'])
+    keys, first_trip, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_trip, kind='stable')
+    keys, counts = keys[order], counts[order]
+
+    group_codes, pairs = np.divmod(keys, stations * stations)
+    starts, ends = np.divmod(pairs, stations)
+    routes = [(station_ids[start], station_ids[end]) for start, end in zip(starts.tolist(), ends.tolist())]
+
+    # Keep only the groups that have trips, numbered in order of their first trip (as RouteCounts does)
+    used, group_codes = np.unique(group_codes, return_inverse=True)
+    first_entry = np.full(len(used), len(group_codes))
+    np.minimum.at(first_entry, group_codes, np.arange(len(group_codes)))
+    renumber = np.empty(len(used), dtype=np.int64)
+    renumber[np.argsort(first_entry, kind='stable')] = np.arange(len(used))
+
+    return RouteRanking([groups[i] for i in used[np.argsort(first_entry, kind='stable')].tolist()],
+                        renumber[group_codes], routes, counts.astype(np.int64))
+
+
+# Same ODMatrix as od_matrix(rows, by), from the table
+def table_od_matrix(table, by=None):
+    return ODMatrix(table_route_ranking(table, by))
+
+
+# Same StationTimeSeries as station_time_series(rows, bucket_minutes), from the table's time columns
+def table_station_time_series(table, bucket_minutes=60):
+    labels = table.categories('Starting Station ID')
+    station_codes = {'Start Time': table['Starting Station ID'], 'End Time': table['Ending Station ID']}
+
+    # Stations in ID order, like the row accumulator
+    used = np.unique(np.concatenate(list(station_codes.values())))
+    order = sorted(used.tolist(), key=lambda code: labels[code])
+    renumber = np.zeros(len(labels), dtype=np.int64)
+    renumber[order] = np.arange(len(order))
+
+    buckets = {column: table[column].astype('datetime64[m]').astype(np.int64) // bucket_minutes
+               for column in TIME_COLUMNS}
+    first = min((int(bucket.min()) for bucket in buckets.values() if len(bucket)), default=0)
+    size = max((int(bucket.max()) for bucket in buckets.values() if len(bucket)), default=first - 1) - first + 1
+
+    arrays = []
+    for column in TIME_COLUMNS:
+        cells = renumber[station_codes[column]] * size + (buckets[column] - first)
+        arrays.append(np.bincount(cells, minlength=len(order) * size).astype(np.int32).reshape(len(order), size))
+
+    return StationTimeSeries([labels[code] for code in order], first, bucket_minutes, *arrays)
+
+
+# BikeUtilization in one pass over the trips sorted by (Bike ID, Start Time)
+def table_bike_utilization(table):
+    order = np.lexsort((table['Start Time'], table['Bike ID']))
+    bikes = table['Bike ID'][order]
+    starts = table['Start Time'][order].astype(np.int64)
+    ends = table['End Time'][order].astype(np.int64)
+
+    if not len(bikes):
+        empty = np.array([], dtype=np.int64)
+        return BikeUtilization([], empty, empty, np.array([]), empty, empty,
+                               empty.astype('datetime64[s]'), empty.astype('datetime64[s]'), [])
+
+    # Each bike's trips are now one run; "first" marks where every run begins
+    is_first = np.r_[True, bikes[1:] != bikes[:-1]]
+    first = np.flatnonzero(is_first)
+    last = np.r_[first[1:] - 1, len(bikes) - 1]
+
+    # Distance of every trip from the station matrix
+    distances = station_distances(table_station_pairs(table).coordinates)
+    matrix_index = np.array([distances.index.get(station_id, -1)
+                             for station_id in table.categories('Starting Station ID')], dtype=np.int64)
+    start_stations = matrix_index[table['Starting Station ID'][order]]
+    end_stations = matrix_index[table['Ending Station ID'][order]]
+    trip_km = np.where((start_stations >= 0) & (end_stations >= 0),
+                       distances.matrix[start_stations.clip(0), end_stations.clip(0)], 0.0)
+
+    # Idle gap before each trip: its start minus the end of the same bike's previous trip
+    gaps = np.zeros(len(bikes), dtype=np.int64)
+    gaps[1:] = starts[1:] - ends[:-1]
+    gaps[is_first] = 0
+    gaps = gaps.clip(0)
+
+    bike_ids = table.categories('Bike ID')
+    station_ids = table.categories('Ending Station ID')
+    return BikeUtilization(
+        [bike_ids[code] for code in bikes[first].tolist()],
+        np.diff(np.r_[first, len(bikes)]),
+        np.add.reduceat(table['Duration'][order], first),
+        np.add.reduceat(np.nan_to_num(trip_km), first),
+        np.add.reduceat(gaps, first),
+        np.maximum.reduceat(gaps, first),
+        starts[first].astype('datetime64[s]'),
+        np.maximum.reduceat(ends, first).astype('datetime64[s]'),
+        [station_ids[code] for code in table['Ending Station ID'][order][last].tolist()])
+
+
+# Same answer as collections.Counter(column).most_common(1), including which ID wins a tie
+def table_most_common(table, column):
+    codes = table[column]
+    if not len(codes):
+        return []
+
+    counts = np.bincount(codes)
+    tied = np.flatnonzero(counts == counts.max())
+
+    # Counter keeps the ID it saw first, so break ties on first occurrence
+    first_seen = [np.argmax(codes == code) for code in tied]
+    winner = tied[int(np.argmin(first_seen))]
+
+    return [(table.categories(column)[winner], int(counts[winner]))]
+
+
+# {date: {label: count}} over the rows in mask, each date starting from a copy of "template"
+def table_per_date_counts(table, start_days, column, mask, template):
+    labels = table.categories(column)
+    days, day_index = np.unique(start_days[mask], return_inverse=True)
+
+    # One bincount over (day, label) pairs instead of a dictionary update per row
+    counts = np.bincount(day_index * len(labels) + table[column][mask],
+                         minlength=len(days) * len(labels)).reshape(len(days), len(labels))
+
+    per_date = {}
+    for date, day_counts in zip(np.datetime_as_string(days, unit='D').tolist(), counts.tolist()):
+        per_date[date] = dict(template)
+        for label, count in zip(labels, day_counts):
+            if count:
+                per_date[date][label] = per_date[date].get(label, 0) + count
+
+    return per_date
+
+
+def table_scatterplot(table, start_days, mask):
+    days, day_index = np.unique(start_days[mask], return_inverse=True)
+
+    one_way = np.bincount(day_index, minlength=len(days))
+    duration_totals = np.bincount(day_index, weights=table['Duration'][mask], minlength=len(days))
+
+    scatterplot_dictionary = {}
+    for date, count, total in zip(np.datetime_as_string(days, unit='D').tolist(),
+                                  one_way.tolist(), duration_totals.tolist()):
+        # Divide by 60 to convert minutes from seconds
+        scatterplot_dictionary[date] = {'One Way': count, 'Duration': (int(total)/count) / 60}
+
+    return scatterplot_dictionary
+
+
+# Same as grouped_counts(), over a TripTable: each grouping is one np.unique call over integer codes
+def table_grouped_counts(table, groupings):
+    return {name: table_grouped_count(table, columns, where) for name, (columns, where) in groupings.items()}
+
+
+def table_grouped_count(table, columns, where=None):
+    mask = None if where is None else where(table)
+    keys = []
+    sizes = []
+    formatters = []
+
+    for column in columns:
+        values = table[column] if mask is None else table[column][mask]
+
+        if column in CATEGORICAL_COLUMNS:
+            keys.append(values)
+            sizes.append(len(table.categories(column)))
+            formatters.append(table.categories(column).__getitem__)
         else:
-            # If am excel box is blank set equal to 0 so the data is not disturbed
-            avg_trip_time_dictionary[trip_ids]['Duration'] = 0
+            # Plain number columns (ex.: Plan Duration) get codes from np.unique first
+            uniques, codes = np.unique(values, return_inverse=True)
+            keys.append(codes.reshape(-1))
+            sizes.append(len(uniques))
+            formatters.append([format_label(column, value) for value in uniques.tolist()].__getitem__)
+
+    if not len(keys[0]):
+        return {}
+
+    # One int64 per trip (mixed radix over the columns' codes); sorted keys are the combinations in column order
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for codes, size in zip(keys, sizes):
+        combined = combined * size + codes
+
+    if np.prod(sizes, dtype=np.float64) <= 4 * len(combined):
+        counts = np.bincount(combined, minlength=int(np.prod(sizes)))
+        combined = np.flatnonzero(counts)
+        counts = counts[combined]
+    else:
+        combined, counts = np.unique(combined, return_counts=True)
+
+    # Back from the combined key to one code per column
+    codes = []
+    for size in reversed(sizes):
+        combined, code = np.divmod(combined, size)
+        codes.append(code.tolist())
 
-    return avg_trip_time_dictionary
+    return {
+        tuple(formatter(code) for formatter, code in zip(formatters, combination)): count
+        for combination, count in zip(zip(*reversed(codes)), counts.tolist())
+    }
 
 
-        
+def table_average_trip_time(table):
+    codes = table['Trip ID']
+    trip_ids = table.categories('Trip ID')
+
+    counts = np.bincount(codes, minlength=len(trip_ids))
+    totals = np.bincount(codes, weights=table['Duration'], minlength=len(trip_ids))
+
+    return {
+        # Divide by 60 to convert minutes from seconds
+        trip_id: {'Duration': (int(total)/count) / 60}
+        for trip_id, count, total in zip(trip_ids, counts.tolist(), totals.tolist())
+        if count
+    }
+
+
+# Same as TripTimeSummary, with every histogram made by one bincount
+def table_trip_time_summary(table, bin_minutes=1, max_minutes=1440, top=20):
+    durations = table['Duration']
+    start_times = table['Start Time']
+    bins = max_minutes // bin_minutes + 1
+
+    if not len(durations):
+        return trip_time_summary(0, 0, None, None, 0.0, None, {}, {}, [], bin_minutes)
+
+    duration_bins = np.minimum(durations // 60 // bin_minutes, bins - 1)
 
+    hours = (start_times.astype('datetime64[h]').astype(np.int64) % 24)
+    hour_counts = np.bincount(hours * bins + duration_bins, minlength=24 * bins).reshape(24, bins)
+
+    days, day_index = np.unique(start_times.astype('datetime64[D]'), return_inverse=True)
+    day_counts = np.bincount(day_index * bins + duration_bins, minlength=len(days) * bins).reshape(len(days), bins)
+
+    # Candidates for the longest trips: everything at least as long as the "top"-th longest
+    top = min(top, len(durations))
+    threshold = np.partition(durations, len(durations) - top)[len(durations) - top]
+    candidates = np.flatnonzero(durations >= threshold)
+    trip_ids = table.categories('Trip ID')
+    longest = sorted(zip(durations[candidates].tolist(),
+                         [trip_ids[code] for code in table['Trip ID'][candidates].tolist()],
+                         np.datetime_as_string(start_times[candidates], unit='s').tolist()),
+                     reverse=True)[:top]
+
+    return trip_time_summary(
+        len(durations), int(durations.sum()), int(durations.min()), int(durations.max()), float(durations.var()),
+        np.bincount(duration_bins, minlength=bins),
+        {hour: hour_counts[hour] for hour in range(24) if hour_counts[hour].any()},
+        dict(zip(np.datetime_as_string(days, unit='D').tolist(), day_counts)),
+        longest, bin_minutes)
+
+
+"""
+Query Section
+
+ Filters, groups and aggregates over a TripTable (or a partitioned store) with vectorized masks
+ Run code in terminal: trips = query(parse(columnar=True))
+    trips.filter(start='2016-08-01', end='2016-08-31', weekday=True).exclude(passholder_type='Staff Annual')
+         .group_by('Start Date', 'Passholder Type').agg(trips=(None, 'count'), minutes=('Duration', 'mean'))
+ Predicates (a single value or a list of values):
+    start, end                  --> first / last day of Start Time (inclusive)
+    weekday                     --> True for Monday-Friday, False for weekends, or weekday numbers (Monday == 0)
+    passholder_type, route, plan_duration, bike,
+    starting_station, ending_station, station (either end)
+"""
+
+# Predicate keyword --> column it tests
+PREDICATE_COLUMNS = {
+    'passholder_type': 'Passholder Type',
+    'route': 'Trip Route Category',
+    'plan_duration': 'Plan Duration',
+    'bike': 'Bike ID',
+    'starting_station': 'Starting Station ID',
+    'ending_station': 'Ending Station ID',
+}
+
+AGGREGATIONS = ['count', 'sum', 'mean', 'min', 'max']
+
+
+def query(source):
+    return Query(source)
+
+
+class Query:
+
+    def __init__(self, source, predicates=(), groups=()):
+        # source: a TripTable, or anything with .tables(first_day, last_day) handing back only the tables
+        # (ex.: date partitions) that can hold trips in that range
+        self.source = source
+        # (keyword, values, negate) in the order they were added
+        self.predicates = tuple(predicates)
+        self.groups = tuple(groups)
+
+    def filter(self, **predicates):
+        return self.where(predicates, negate=False)
+
+    # Drops the trips matching any of the predicates, ex.: exclude(passholder_type='Staff Annual', plan_duration=0)
+    def exclude(self, **predicates):
+        return self.where(predicates, negate=True)
+
+    def where(self, predicates, negate):
+        for keyword, values in predicates.items():
+            if keyword not in PREDICATE_COLUMNS and keyword not in ('start', 'end', 'weekday', 'station'):
+                raise ValueError('Unknown predicate {!r}'.format(keyword))
+
+        added = tuple((keyword, values, negate) for keyword, values in predicates.items())
+        return Query(self.source, self.predicates + added, self.groups)
+
+    # Columns to group by, plus 'Start Date' (day of Start Time) and 'Start Hour'
+    def group_by(self, *columns):
+        return Query(self.source, self.predicates, self.groups + columns)
+
+    # First and last day the filters allow (None when open ended), used to skip whole partitions
+    def date_range(self):
+        first = last = None
+        for keyword, value, negate in self.predicates:
+            if negate or keyword not in ('start', 'end'):
+                continue
+            day = np.datetime64(value, 'D')
+            if keyword == 'start':
+                first = day if first is None else max(first, day)
+            else:
+                last = day if last is None else min(last, day)
+        return first, last
+
+    def tables(self):
+        if hasattr(self.source, 'tables'):
+            return self.source.tables(*self.date_range())
+        return [self.source]
+
+    # Boolean mask of the table's trips passing every predicate
+    def mask(self, table):
+        mask = np.ones(len(table), dtype=bool)
+        for keyword, values, negate in self.predicates:
+            matches = predicate_mask(table, keyword, values)
+            mask &= ~matches if negate else matches
+        return mask
+
+    def count(self):
+        return sum(int(self.mask(table).sum()) for table in self.tables())
+
+    # The matching trips as one TripTable (partitions share their label lists, so codes line up)
+    def table(self):
+        parts = [(table, self.mask(table)) for table in self.tables()]
+        if not parts:
+            return TripTable.from_rows([])
+        columns = {column: np.concatenate([table[column][mask] for table, mask in parts])
+                   for column in parts[0][0].columns}
+        return TripTable(columns, parts[0][0].labels)
+
+    # outputs: {name: (column, 'count' | 'sum' | 'mean' | 'min' | 'max')}, column is ignored for 'count'
+    # Returns {name: value} without group_by(), otherwise {group: {name: value}} with one label per group column
+    # (a tuple of labels when grouping by more than one column)
+    def agg(self, **outputs):
+        for name, (column, function) in outputs.items():
+            if function not in AGGREGATIONS:
+                raise ValueError('{} must be one of {}, not {!r}'.format(name, AGGREGATIONS, function))
+
+        columns = sorted({column for column, function in outputs.values() if function != 'count'})
+        # {group labels: {'count': trips, (column, 'sum' / 'min' / 'max'): value}} merged over every table
+        totals = {}
+        for table in self.tables():
+            mask = self.mask(table)
+            for key, partial in group_partials(table, mask, self.groups, columns).items():
+                if key not in totals:
+                    totals[key] = partial
+                    continue
+                total = totals[key]
+                for part, value in partial.items():
+                    if part == 'count' or part[1] == 'sum':
+                        total[part] += value
+                    else:
+                        total[part] = (min if part[1] == 'min' else max)(total[part], value)
+
+        results = {}
+        for key in sorted(totals):
+            total = totals[key]
+            values = {}
+            for name, (column, function) in outputs.items():
+                if function == 'count':
+                    values[name] = total['count']
+                elif function == 'mean':
+                    values[name] = total[(column, 'sum')] / total['count']
+                else:
+                    values[name] = total[(column, function)]
+
+                if column in TIME_COLUMNS and function != 'count':
+                    values[name] = np.datetime64(int(values[name]), 's').tolist()
+            results[key[0] if len(key) == 1 else key] = values
+
+        if not self.groups:
+            return results.get((), {name: 0 if function == 'count' else None
+                                    for name, (column, function) in outputs.items()})
+        return results
+
+
+# Mask of the trips matching one predicate
+def predicate_mask(table, keyword, values):
+    if keyword in ('start', 'end'):
+        days = table['Start Time'].astype('datetime64[D]')
+        day = np.datetime64(values, 'D')
+        return days >= day if keyword == 'start' else days <= day
+
+    if keyword == 'weekday':
+        # 1970-01-01 was a Thursday, so shifting the day number by 3 matches date.weekday() (Monday == 0)
+        weekdays = (table['Start Time'].astype('datetime64[D]').astype(np.int64) + 3) % 7
+        if values is True or values is False:
+            return (weekdays < 5) == values
+        return np.isin(weekdays, np.atleast_1d(values))
+
+    if keyword == 'station':
+        return predicate_mask(table, 'starting_station', values) | predicate_mask(table, 'ending_station', values)
+
+    column = PREDICATE_COLUMNS[keyword]
+    values = values if isinstance(values, (list, tuple, set)) else [values]
+    if column in CATEGORICAL_COLUMNS:
+        # Labels that never show up get code -1, which matches nothing
+        values = [table.code(column, value) for value in values]
+    return np.isin(table[column], list(values))
+
+
+# Codes (one per masked trip) and the label of every code, for one group_by() column
+def group_codes(table, column, mask):
+    if column == 'Start Date':
+        days, codes = np.unique(table['Start Time'][mask].astype('datetime64[D]'), return_inverse=True)
+        return codes, np.datetime_as_string(days).tolist()
+
+    if column == 'Start Hour':
+        values = table['Start Time'][mask].astype('datetime64[h]').astype(np.int64) % 24
+    else:
+        values = table[column][mask]
+
+    values, codes = np.unique(values, return_inverse=True)
+    if column in CATEGORICAL_COLUMNS:
+        labels = table.categories(column)
+        return codes, [labels[code] for code in values.tolist()]
+    return codes, values.tolist()
+
+
+# {group labels: {'count': trips, (column, 'sum' / 'min' / 'max'): value}} for one table
+def group_partials(table, mask, groups, columns):
+    trips = int(mask.sum())
+    if not trips:
+        return {}
+
+    keys = [()]
+    group_index = np.zeros(trips, dtype=np.int64)
+    if groups:
+        codes, labels = zip(*[group_codes(table, column, mask) for column in groups])
+        combinations, group_index = np.unique(np.stack([code.reshape(-1) for code in codes], axis=1),
+                                              axis=0, return_inverse=True)
+        group_index = group_index.reshape(-1)
+        keys = [tuple(labels[i][code] for i, code in enumerate(combination))
+                for combination in combinations.tolist()]
+
+    counts = np.bincount(group_index, minlength=len(keys))
+    partials = [{'count': int(count)} for count in counts.tolist()]
+
+    # Sorting the trips by group turns every group into one run for the reduceat()s below
+    order = np.argsort(group_index, kind='stable')
+    runs = np.r_[0, np.cumsum(counts)[:-1]]
+
+    for column in columns:
+        values = table[column][mask][order]
+        if column in TIME_COLUMNS:
+            values = values.astype(np.int64)
+        sums = np.add.reduceat(values, runs)
+        minimums = np.minimum.reduceat(values, runs)
+        maximums = np.maximum.reduceat(values, runs)
+
+        for partial, total, low, high in zip(partials, sums.tolist(), minimums.tolist(), maximums.tolist()):
+            partial[(column, 'sum')] = total
+            partial[(column, 'min')] = low
+            partial[(column, 'max')] = high
+
+    return dict(zip(keys, partials))
+
+
+"""
+Station Index Section
+
+ Grid index over the stations' coordinates for nearest-station and radius queries
+ Run code in terminal: index = StationIndex(x['Bike Share Paths'].coordinates)
+    index.nearest(latitudes, longitudes)         --> nearest station & its distance (km) for every point
+    index.within(latitude, longitude, 0.5)       --> stations within 500 m of one point
+    index.within_many(latitudes, longitudes, 0.5) --> the same for millions of points at once
+    index.clusters(0.5)                          --> groups of stations chained together by gaps of 500 m or less
+"""
+
+
+class StationIndex:
+
+    # Points handled per distance matrix, so millions of points never build one huge array
+    batch_size = 100000
+
+    def __init__(self, coordinates, cell_km=0.5):
+        # Stations with an empty coordinate can not be placed on the grid
+        coordinates = {station_id: (lat, lon) for station_id, (lat, lon) in coordinates.items() if lat and lon}
+
+        self.station_ids = list(coordinates)
+        self.latitudes = np.array([lat for lat, lon in coordinates.values()], dtype=np.float64)
+        self.longitudes = np.array([lon for lat, lon in coordinates.values()], dtype=np.float64)
+        self.cell_km = cell_km
+
+        # Flat km grid around the stations (good to well under 1% across a city); reported distances use haversine()
+        self.origin = (float(self.latitudes.mean()), float(self.longitudes.mean())) if self.station_ids else (0.0, 0.0)
+        self.km_per_latitude = Radius_of_earth * np.pi / 180
+        self.km_per_longitude = self.km_per_latitude * np.cos(np.radians(self.origin[0]))
+
+        self.cell_x, self.cell_y = self.cells(self.latitudes, self.longitudes)
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def cells(self, latitudes, longitudes):
+        x = (np.asarray(longitudes, dtype=np.float64) - self.origin[1]) * self.km_per_longitude
+        y = (np.asarray(latitudes, dtype=np.float64) - self.origin[0]) * self.km_per_latitude
+        return np.floor(x / self.cell_km).astype(np.int64), np.floor(y / self.cell_km).astype(np.int64)
+
+    # Indices of the stations in cells at most "ring" cells away from cell (x, y)
+    def candidates(self, x, y, ring):
+        return np.flatnonzero(np.maximum(np.abs(self.cell_x - x), np.abs(self.cell_y - y)) <= ring)
+
+    # Points grouped by grid cell: yields (cell x, cell y, indices of the points in that cell)
+    def points_by_cell(self, cell_x, cell_y):
+        cells, cell_index = np.unique(np.stack([cell_x, cell_y], axis=1), axis=0, return_inverse=True)
+        order = np.argsort(cell_index.reshape(-1), kind='stable')
+        bounds = np.cumsum(np.bincount(cell_index.reshape(-1), minlength=len(cells)))
+
+        start = 0
+        for (x, y), end in zip(cells.tolist(), bounds.tolist()):
+            yield x, y, order[start:end]
+            start = end
+
+    # Returns (station ids, distances in km) of the nearest station to every point
+    def nearest(self, latitudes, longitudes):
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+
+        if not self.station_ids:
+            raise ValueError('StationIndex has no stations')
+        nearest = np.zeros(len(latitudes), dtype=np.int64)
+
+        for x, y, points in self.points_by_cell(*self.cells(latitudes, longitudes)):
+            # Start at the first ring that reaches any station, then widen until the best match is provably the nearest
+            ring = int(max(0, self.cell_x.min() - x, x - self.cell_x.max(), self.cell_y.min() - y, y - self.cell_y.max()))
+
+            while True:
+                candidates = self.candidates(x, y, ring)
+                if len(candidates):
+                    # Every station within ring * cell_km of a point in this cell is already a candidate
+                    if self.flat_distances(latitudes[points], longitudes[points], candidates) <= ring * self.cell_km \
+                            or len(candidates) == len(self.station_ids):
+                        # One extra ring covers the flat grid's small distortion before picking by haversine()
+                        nearest[points] = self.closest(latitudes[points], longitudes[points],
+                                                       self.candidates(x, y, ring + 1))
+                        break
+                ring += 1
+
+        distances = haversine(latitudes, longitudes, self.latitudes[nearest], self.longitudes[nearest])
+        return [self.station_ids[i] for i in nearest.tolist()], distances
+
+    # Largest flat-grid distance (km) from any of the points to its closest candidate
+    def flat_distances(self, latitudes, longitudes, candidates):
+        largest = 0.0
+        for start in range(0, len(latitudes), self.batch_size):
+            chunk = slice(start, start + self.batch_size)
+            dx = (longitudes[chunk, None] - self.longitudes[None, candidates]) * self.km_per_longitude
+            dy = (latitudes[chunk, None] - self.latitudes[None, candidates]) * self.km_per_latitude
+            largest = max(largest, float(np.hypot(dx, dy).min(axis=1).max()))
+        return largest
+
+    # Station index of the candidate closest (by haversine()) to each point
+    def closest(self, latitudes, longitudes, candidates):
+        best = np.empty(len(latitudes), dtype=np.int64)
+        for start in range(0, len(latitudes), self.batch_size):
+            chunk = slice(start, start + self.batch_size)
+            distances = haversine(latitudes[chunk, None], longitudes[chunk, None],
+                                  self.latitudes[None, candidates], self.longitudes[None, candidates])
+            best[chunk] = candidates[distances.argmin(axis=1)]
+        return best
+
+    # [(station id, km), ...] within radius_km of one point, nearest first
+    def within(self, latitude, longitude, radius_km):
+        points, station_ids, distances = self.within_many([latitude], [longitude], radius_km)
+        return sorted(zip(station_ids, distances.tolist()), key=lambda station: station[1])
+
+    # Every (point, station) pair closer than radius_km: (point indices, station ids, distances in km)
+    def within_many(self, latitudes, longitudes, radius_km):
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+
+        # One extra ring covers the flat grid's small distortion
+        ring = int(np.ceil(radius_km / self.cell_km)) + 1
+        found_points, found_stations, found_distances = [], [], []
+
+        for x, y, points in self.points_by_cell(*self.cells(latitudes, longitudes)):
+            candidates = self.candidates(x, y, ring)
+            if not len(candidates):
+                continue
+
+            for start in range(0, len(points), self.batch_size):
+                chunk = points[start:start + self.batch_size]
+                distances = haversine(latitudes[chunk, None], longitudes[chunk, None],
+                                      self.latitudes[None, candidates], self.longitudes[None, candidates])
+                point_index, candidate_index = np.nonzero(distances <= radius_km)
+
+                found_points.append(chunk[point_index])
+                found_stations.append(candidates[candidate_index])
+                found_distances.append(distances[point_index, candidate_index])
+
+        if not found_points:
+            return np.array([], dtype=np.int64), [], np.array([])
+
+        points = np.concatenate(found_points)
+        order = np.argsort(points, kind='stable')
+        stations = np.concatenate(found_stations)[order]
+
+        return points[order], [self.station_ids[i] for i in stations.tolist()], np.concatenate(found_distances)[order]
+
+    # Stations linked whenever two are within radius_km of each other: [[station id, ...], ...] biggest group first
+    def clusters(self, radius_km):
+        points, neighbours, _ = self.within_many(self.latitudes, self.longitudes, radius_km)
+        index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+
+        # Union-find over the station pairs
+        parents = list(range(len(self.station_ids)))
+
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for point, neighbour in zip(points.tolist(), neighbours):
+            parents[root(point)] = root(index[neighbour])
+
+        groups = collections.defaultdict(list)
+        for i, station_id in enumerate(self.station_ids):
+            groups[root(i)].append(station_id)
+
+        return sorted(groups.values(), key=len, reverse=True)
 
 
 """
 Graphs Section
+
+ Every graph is handed to publish():
+    online (default)  --> uploaded with ply.plot and embedded from its Plotly URL
+    offline           --> written as a local html page, no Plotly account or network needed
+ Pass offline=True to a graph function, or set BIKESHARE_OFFLINE=1 to render everything offline
 """
 
+# Offline pages load plotly.js from this file next to them, written once instead of inlined in every page
+PLOTLY_JS = 'plotly.min.js'
+
+# The '#252830' background every page uses
+DARK_BACKGROUND = dict(
+    paper_bgcolor='#252830',
+    plot_bgcolor='#252830',
+)
+
+# DARK_BACKGROUND plus white axes & legend font, shared by the bar and pie charts
+DARK_THEME = dict(
+    DARK_BACKGROUND,
+    xaxis=dict(
+        color='#fff',
+        zerolinecolor='rgb(255,255,255)',
+        tickcolor='#fff'
+    ),
+    yaxis=dict(
+        color='#fff',
+        zerolinecolor='rgb(255,255,255)',
+        tickcolor='#fff'
+    ),
+    legend=dict(
+        traceorder='normal',
+        font=dict(
+            color='#fff'
+        ),
+    )
+)
+
+
+# A fresh copy of "theme" with "layout" merged over it, ex.: themed_layout(title='Trip Routes', xaxis=dict(title='Date'))
+# Nested dictionaries are merged key by key, so xaxis=dict(title=...) keeps the theme's axis colors
+def themed_layout(theme=DARK_THEME, **layout):
+    themed = copy.deepcopy(theme)
+    merge_layout(themed, layout)
+    return themed
+
+
+def merge_layout(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_layout(target[key], value)
+        else:
+            target[key] = value
+
+
+# Figures are plain {'data': [...], 'layout': {...}} dictionaries, so building one does no Plotly validation
+# Plotly validates a figure once when it is published, and only the FIRST time a figure with that
+# structure (trace types & keys, layout keys) is published: per-day or per-station variants of a chart skip it
+_validated_structures = set()
+
+
+def figure_structure(fig):
+    traces = tuple((trace.get('type'), tuple(sorted(trace))) for trace in fig['data'])
+    return traces, tuple(sorted(fig['layout']))
+
+
+# offline=None --> follow the BIKESHARE_OFFLINE environment variable
+def offline_mode(offline=None):
+    if offline is None:
+        return os.environ.get('BIKESHARE_OFFLINE') == '1'
+    return offline
+
+
+def publish(fig, filename, offline=None):
+    structure = figure_structure(fig)
+    validate = structure not in _validated_structures
+
+    if offline_mode(offline):
+        write_offline_html(fig, filename, validate)
+    else:
+        # ply.sign(username, APIkey)
+        ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
+        url = ply.plot(fig, auto_open=False, validate=validate)
+        print(url)
+        open(filename, "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
+
+    _validated_structures.add(structure)
+
+
+def write_offline_html(fig, filename, validate=True):
+    write_plotly_js(os.path.dirname(os.path.abspath(filename)))
+
+    # Only the figure's own <div> & data go in the page
+    div = plo.plot(fig, output_type='div', include_plotlyjs=False, auto_open=False, validate=validate)
+
+    with open(filename, "w") as page:
+        page.write('<html><head><meta charset="utf-8" /><script src="{}"></script></head><body>'.format(PLOTLY_JS)
+                   + "<h1>My cool graph</h1>" + div + '</body></html>')
+
+
+# (Re)writes the shared plotly.js only when it is missing or belongs to another plotly version
+def write_plotly_js(directory):
+    path = os.path.join(directory, PLOTLY_JS)
+    plotly_js = plo.get_plotlyjs()
+
+    if not os.path.exists(path) or os.path.getsize(path) != len(plotly_js.encode('utf-8')):
+        # Written to a temporary name then swapped in, so pages rendered in parallel never see half a file
+        temporary = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(temporary, "w", encoding='utf-8') as bundle:
+            bundle.write(plotly_js)
+        os.replace(temporary, path)
+
+
 # Data Visualizations total amount of monthly passes and flex passes each day
 
 
-def regular_commuters_graph(passholder_types_dates):
+def regular_commuters_graph(passholder_types_dates, offline=None):
     # Omitted Walk up because there are NOT using bike shares regularly
 
     passholder_types_dates = sorted(passholder_types_dates.items())
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            title='Date',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            title='Passholder Types',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
+    layout = themed_layout(
+        xaxis=dict(title='Date'),
+        yaxis=dict(title='Passholder Types'),
     )
 
-    fig = go.Figure(layout=layout)
+    fig = dict(data=[
 
-    # Bar chart for Monthly Pass
-    fig.add_bar(
+        # Bar chart for Monthly Pass
+        dict(
+            type='bar',
 
-        # k is short for "Key"
-        x=[k for k, v in passholder_types_dates],
+            # k is short for "Key"
+            x=[k for k, v in passholder_types_dates],
 
-        # v is short for "Value"
-        y=[v['Monthly Pass'] for k, v in passholder_types_dates],
-        name='Monthly Pass'
-    )
+            # v is short for "Value"
+            y=[v['Monthly Pass'] for k, v in passholder_types_dates],
+            name='Monthly Pass'
+        ),
 
-    # Bar chart for Flex Pass
-    fig.add_bar(
-        x=[k for k, v in passholder_types_dates],
-        y=[v['Flex Pass'] for k, v in passholder_types_dates],
-        name='Flex Pass'
-    )
+        # Bar chart for Flex Pass
+        dict(
+            type='bar',
+            x=[k for k, v in passholder_types_dates],
+            y=[v['Flex Pass'] for k, v in passholder_types_dates],
+            name='Flex Pass'
+        ),
+    ], layout=layout)
 
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Monthly-and-Flex-Pass.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
+    publish(fig, "Monthly-and-Flex-Pass.html", offline)
 
 
 # Data Visualizations for total amount of Round Trip (Trip Route) types and One Way (Trip Route) each day
-def most_popular_trip_routes_graph(trip_route_dates):
+def most_popular_trip_routes_graph(trip_route_dates, offline=None):
 
     trip_route_dates = sorted(trip_route_dates.items())
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            title='Date',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            title='Trip Routes',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
+    layout = themed_layout(
+        xaxis=dict(title='Date'),
+        yaxis=dict(title='Trip Routes'),
         title='Most Popular Trip Routes',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
     )
 
-    fig = go.Figure(layout=layout)
+    fig = dict(data=[
 
-    # Bar chart for Round Trip
-    fig.add_bar(
-        # k is short for "Key"
-        x=[k for k, v in trip_route_dates],
-        # v is short for "Value"
-        y=[v['Round Trip'] for k, v in trip_route_dates],
-        name='RoundTrip'
-    )
+        # Bar chart for Round Trip
+        dict(
+            type='bar',
+            # k is short for "Key"
+            x=[k for k, v in trip_route_dates],
+            # v is short for "Value"
+            y=[v['Round Trip'] for k, v in trip_route_dates],
+            name='RoundTrip'
+        ),
 
-    # Bar chart for One Way
-    fig.add_bar(
-        x=[k for k, v in trip_route_dates],
-        y=[v['One Way'] for k, v in trip_route_dates],
-        name='One Way'
-    )
+        # Bar chart for One Way
+        dict(
+            type='bar',
+            x=[k for k, v in trip_route_dates],
+            y=[v['One Way'] for k, v in trip_route_dates],
+            name='One Way'
+        ),
+    ], layout=layout)
 
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("most-popular-trip-routes.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
+    publish(fig, "most-popular-trip-routes.html", offline)
 
 
-def scatterplot_graph(scatterplot_dictionary):
+def scatterplot_graph(scatterplot_dictionary, offline=None):
 
     scatterplot_data_for_graph = sorted(scatterplot_dictionary.items())
 
-    layout = go.Layout(
+    layout = themed_layout(
+        DARK_BACKGROUND,
         scene=dict(
             xaxis=dict(
                 zerolinecolor='rgb(255,255,255)',
@@ -569,15 +3072,12 @@ def scatterplot_graph(scatterplot_dictionary):
             t=0,
             b=0
         ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
     )
 
-    fig = go.Figure(layout=layout)
-
     # k is short for "Key"
     # v is short for "Value"
-    fig.add_scatter3d(
+    fig = dict(data=[dict(
+        type='scatter3d',
 
         # Date
         x=[k for k, v in scatterplot_data_for_graph],
@@ -593,264 +3093,164 @@ def scatterplot_graph(scatterplot_dictionary):
             # colorscale='Viridis',   # choose a colorscale
             opacity=0.8
         )
-    )
+    )], layout=layout)
 
-    # import pdb;pdb.set_trace()
-# fig.layout.title = 'ScatterPlot'
-# ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("scatterplot.html", "w").write(
-        "<h1>My cool graph</h1>" + tls.get_embed(url))
+    publish(fig, "scatterplot.html", offline)
 
 
-def combination_piechart(combinations_dictionary):
+# Pie chart of {combination tuple: count}, labels are the combination joined with label_format
+def combination_pie(combinations_dictionary, title, label_format):
 
     data_combinations = sorted(combinations_dictionary.items())
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
-        title='Trip Route & Passholder Type Combinations',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
-    )
-
-    fig = go.Figure(layout=layout)
-
-    fig.add_pie(
+    return dict(data=[dict(
+        type='pie',
 
         # Write combinations abbreviations later
-        labels=["{} & {}".format(*k) for (k, v) in data_combinations],
+        labels=[label_format.format(*k) for (k, v) in data_combinations],
 
         values=[v for (k, v) in data_combinations]
-    )
+    )], layout=themed_layout(title=title))
 
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Trip-Route_and_Passholder-Type-Combinations.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
 
+def combination_piechart(combinations_dictionary, offline=None):
 
-def combination_piechart2(combinations_dictionary2):
+    fig = combination_pie(combinations_dictionary, 'Trip Route & Passholder Type Combinations', "{} & {}")
 
-    data_combinations = sorted(combinations_dictionary2.items())
+    publish(fig, "Trip-Route_and_Passholder-Type-Combinations.html", offline)
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
-        title='Trip Route, Passholder Type, and Plan Durations Combinations',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
-    )
 
-    fig = go.Figure(layout=layout)
+def combination_piechart2(combinations_dictionary2, offline=None):
 
-    fig.add_pie(
+    fig = combination_pie(combinations_dictionary2,
+                          'Trip Route, Passholder Type, and Plan Durations Combinations', "{}, {}, {}")
 
-        # Write combinations abbreviations later
-        labels=["{}, {}, {}".format(*k) for (k, v) in data_combinations],
-
-        values=[v for (k, v) in data_combinations]
-    )
-
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Trip-Route_Passholder-Type_Plan-Duration-Combos.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
-
-
-def combination_piechart3(combinations_dictionary3):
-
-    data_combinations = sorted(combinations_dictionary3.items())
+    publish(fig, "Trip-Route_Passholder-Type_Plan-Duration-Combos.html", offline)
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
-        title='Passholder Type & Plan Duration Combinations',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
-    )
 
-    fig = go.Figure(layout=layout)
+def combination_piechart3(combinations_dictionary3, offline=None):
 
-    fig.add_pie(
+    fig = combination_pie(combinations_dictionary3, 'Passholder Type & Plan Duration Combinations', "{} & {}")
 
-        # Write combinations abbreviations later
-        labels=["{} & {}".format(*k) for (k, v) in data_combinations],
+    publish(fig, "Passholder-Type_and_Plan-Duration-Combinations.html", offline)
 
-        values=[v for (k, v) in data_combinations]
-    )
 
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Passholder-Type_and_Plan-Duration-Combinations.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
+def combination_piechart4(combinations_dictionary4, offline=None):
 
+    fig = combination_pie(combinations_dictionary4, 'Trip Routes & Plan Duration Combinations', "{} & {}")
 
-def combination_piechart4(combinations_dictionary4):
+    publish(fig, "Trip-Routes_and_Plan-Duration-Combinations.html", offline)
 
-    data_combinations = sorted(combinations_dictionary4.items())
 
-    layout = go.Layout(
-        xaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        yaxis=dict(
-            color='#fff',
-            zerolinecolor='rgb(255,255,255)',
-            tickcolor='#fff'
-        ),
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
-        title='Trip Routes & Plan Duration Combinations',
-        legend=dict(
-            traceorder='normal',
-            font=dict(
-                color='#fff'
-            ),
-        )
-    )
+def avg_trip_time_graph(avg_trip_time_dictionary, offline=None):
 
-    fig = go.Figure(layout=layout)
+    trip_time_averages = sorted(avg_trip_time_dictionary.items())
 
-    fig.add_pie(
+    x_values = [k for k, v in trip_time_averages]
+    y_values = [v['Duration'] for k, v in trip_time_averages]
 
-        # Write combinations abbreviations later
-        labels=["{} & {}".format(*k) for (k, v) in data_combinations],
+    fig = dict(data=[dict(
+        type='table',
 
-        values=[v for (k, v) in data_combinations]
-    )
+        header=dict(values=['Trip ID', 'Average Duration(Minutes)'],
+                    line=dict(color='#7D7F80'),
+                    fill=dict(color='#a1c3d1'),
+                    align=['left'] * 5),
+        cells=dict(values=[[x_values],
+                           [y_values]],
+                   line=dict(color='#7D7F80'),
+                   fill=dict(color='#EDFAFF'),
+                   align=['left'] * 5
+                   )
+    )], layout=themed_layout(DARK_BACKGROUND))
 
-    # ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Trip-Routes_and_Plan-Duration-Combinations.html",
-         "w").write("<h1>My cool graph</h1>" + tls.get_embed(url))
+    publish(fig, "Average-Trip-Time.html", offline)
 
 
-def avg_trip_time_graph(avg_trip_time_dictionary):
+# Average-Trip-Time.html from the Trip Time Summary: its size stays the same however many trips there are
+def trip_time_summary_graph(summary, offline=None):
 
-    trip_time_averages = sorted(avg_trip_time_dictionary.items())
+    if not summary['Trips']:
+        return
 
-    x_values = [k for k, v in trip_time_averages]
-    y_values = [v['Duration'] for k, v in trip_time_averages]
+    histogram = sorted(summary['Histogram'].items())
+    hours = sorted(summary['Percentiles by Hour'].items())
 
-    layout = go.Layout(
-        paper_bgcolor='#252830',
-        plot_bgcolor='#252830',
+    layout = themed_layout(
+        title='Trip Time: {} trips, average {:.1f} minutes'.format(
+            summary['Trips'], summary['Average Duration(Minutes)']),
+        # Histogram on the top left, percentiles per hour on the top right, longest trips underneath
+        xaxis=dict(title='Duration (Minutes)', domain=[0, 0.45]),
+        yaxis=dict(title='Trips', domain=[0.45, 1]),
+        xaxis2=dict(title='Hour of Day', domain=[0.55, 1], anchor='y2', color='#fff', tickcolor='#fff'),
+        yaxis2=dict(title='Duration (Minutes)', domain=[0.45, 1], anchor='x2', color='#fff', tickcolor='#fff'),
     )
 
+    data = [dict(
+        type='bar',
+        # k is short for "Key"
+        x=[k for k, v in histogram],
+        # v is short for "Value"
+        y=[v for k, v in histogram],
+        name='Trips'
+    )]
+
+    # One line per percentile across the hours of the day
+    for percentile in ['{}%'.format(percentile) for percentile in PERCENTILES]:
+        data.append(dict(
+            type='scatter',
+            xaxis='x2',
+            yaxis='y2',
+            x=[k for k, v in hours],
+            y=[v[percentile] for k, v in hours],
+            mode='lines+markers',
+            name=percentile
+        ))
 
-    fig = go.Figure(layout=layout)
-
-    fig.add_table(
+    longest = summary['Longest Trips']
+    data.append(dict(
+        type='table',
+        domain=dict(x=[0, 1], y=[0, 0.35]),
+        header=dict(values=['Trip ID', 'Duration(Minutes)', 'Start Time'],
+                    line=dict(color='#7D7F80'),
+                    fill=dict(color='#a1c3d1'),
+                    align=['left'] * 3),
+        cells=dict(values=[[trip['Trip ID'] for trip in longest],
+                           ['{:.1f}'.format(trip['Duration(Minutes)']) for trip in longest],
+                           [trip['Start Time'] for trip in longest]],
+                   line=dict(color='#7D7F80'),
+                   fill=dict(color='#EDFAFF'),
+                   align=['left'] * 3)
+    ))
 
-        #     # Trip ID
-        # x=[k for k, v in trip_time_averages],
+    publish(dict(data=data, layout=layout), "Average-Trip-Time.html", offline)
 
-        #     # One Way Trips
-        # y=[v['Duration'] for k, v in trip_time_averages],
-        # # Graph accessories
 
-        header=dict(values=['Trip ID', 'Average Duration(Minutes)'],
-            line = dict(color='#7D7F80'),
-                fill = dict(color='#a1c3d1'),
-                align = ['left'] * 5),
-        cells=dict(values=[[x_values],
-                        [y_values]],
-             line = dict(color='#7D7F80'),
-               fill = dict(color='#EDFAFF'),
-               align = ['left'] * 5
-        )
-            )
+def longitudes_and_latitudes_graph(rows, offline=None):
+    # Trips per station pair plus every station's coordinates
+    bike_share_paths_graph(aggregate(rows, {'Station Pairs': StationPairs()})['Station Pairs'], offline)
 
-    # import pdb;pdb.set_trace()
-# fig.layout.title = 'ScatterPlot'
-# ply.sign(username, APIkey)
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Average-Trip-Time.html", "w").write(
-        "<h1>My cool graph</h1>" + tls.get_embed(url))
 
+# Same map straight from main()'s x['Bike Share Paths'], without going over the rows again
+def bike_share_paths_graph(station_pairs, offline=None):
 
+    # Distances come from the cached station matrix
+    distances = station_pairs.distances()
 
-def longitudes_and_latitudes_graph(rows):
-    
-    station_dict = {}
+    station_dict = station_pairs.coordinates
     trip_dict = {}
-    max_counter = 1
-
-    for row in rows:
-
-        station_dict[ row['Starting Station ID'] ] = (row['Starting Station Latitude'], row['Starting Station Longitude'])
 
-        key = (row['Starting Station ID'], row['Ending Station ID'])
-        if key not in trip_dict:
-
-            trip_dict[key] = [row['Starting Station Latitude'], row['Starting Station Longitude'], row['Ending Station Latitude'], row['Ending Station Longitude'], 0]
-
-            # "+=1" for the counter i.e 0
-        trip_dict[key][4]+=1
-        max_counter = max(max_counter, trip_dict[key][4])
+    for key, counter in station_pairs.trip_counts.items():
+        # A pair can only be drawn when both stations have coordinates
+        if key[0] in station_dict and key[1] in station_dict:
+            trip_dict[key] = [*station_dict[key[0]], *station_dict[key[1]], counter]
 
+    max_counter = max(station_pairs.trip_counts.values(), default=1)
 
 
     layout = dict(
-        title = 'Bike Share Paths',
+        # Trip-weighted average distance, straight from the station pair counts
+        title = 'Bike Share Paths (average trip {:.2f} km)'.format(station_pairs.average_distance()),
         showlegend = False, 
         geo = dict(
             scope='usa',
@@ -880,11 +3280,11 @@ def longitudes_and_latitudes_graph(rows):
             )
         ))]
 
-        # t is reffering to the built-in "sorted" tuple
-    trip_dict =sorted(trip_dict.items(), key=(lambda t: -t[1][4]))
+        # Only the busiest routes are drawn, so a heap picks them instead of sorting every pair
+    top_routes = heapq.nlargest(TOP_ROUTES, trip_dict.items(), key=(lambda t: t[1][4]))
         
     bike_share_paths = []
-    for (key, (st_lat, st_lon, end_lat, end_lon, counter)) in trip_dict[:50]:
+    for (key, (st_lat, st_lon, end_lat, end_lon, counter)) in top_routes:
         bike_share_paths.append(
         dict(
             type = 'scattergeo',
@@ -896,19 +3296,71 @@ def longitudes_and_latitudes_graph(rows):
                 width = 1,
                 color = 'red',
             ),
+            hoverinfo = 'text',
+            text = '{} to {}: {} trips, {:.2f} km'.format(key[0], key[1], counter, distances.distance(*key)),
             opacity = float(counter)/float(max_counter),
         )
     )
 
     # import pdb; pdb.set_trace()
 
-    fig = go.Figure(data=stations + bike_share_paths, layout=layout)
+    fig = dict(data=stations + bike_share_paths, layout=layout)
+
+    publish(fig, "Bike-Share-Trip-Path.html", offline)
+
+
+"""
+Render All Section
+
+ Run code in terminal: render_all(x)
+ Where "x" = main(); every page below is built at the same time and each page's wall time is reported
+"""
+
+# (graph function, key of its data in main()'s dictionary, page it writes)
+GRAPHS = [
+    (regular_commuters_graph, 'Number of Regular Commuters', 'Monthly-and-Flex-Pass.html'),
+    (most_popular_trip_routes_graph, 'Most Popular Trip Routes', 'most-popular-trip-routes.html'),
+    (scatterplot_graph, 'Scatterplot', 'scatterplot.html'),
+    (combination_piechart, 'Pie Chart of Combinations', 'Trip-Route_and_Passholder-Type-Combinations.html'),
+    (combination_piechart2, '2nd Pie Chart of Combinations', 'Trip-Route_Passholder-Type_Plan-Duration-Combos.html'),
+    (combination_piechart3, '3rd Pie Chart of Combinations', 'Passholder-Type_and_Plan-Duration-Combinations.html'),
+    (combination_piechart4, '4th Pie Chart of Combinations', 'Trip-Routes_and_Plan-Duration-Combinations.html'),
+    (trip_time_summary_graph, 'Trip Time Summary', 'Average-Trip-Time.html'),
+    (bike_share_paths_graph, 'Bike Share Paths', 'Bike-Share-Trip-Path.html'),
+]
+
+
+# Pages are built on a thread pool, which shares publish()'s validate-once cache and needs no pickling of x;
+# processes=True moves them to a process pool instead (each worker then starts with an empty cache)
+def render_all(x, offline=None, workers=None, processes=False):
+    offline = offline_mode(offline)
+
+    if offline:
+        # Written once up front rather than raced for by every page
+        write_plotly_js(os.getcwd())
+
+    pool = futures.ProcessPoolExecutor if processes else futures.ThreadPoolExecutor
+    wall_times = {}
+
+    with pool(max_workers=workers or len(GRAPHS)) as executor:
+        rendering = {
+            executor.submit(timed_graph, graph, x[key], offline): filename
+            for graph, key, filename in GRAPHS
+        }
+
+        for finished in futures.as_completed(rendering):
+            wall_times[rendering[finished]] = finished.result()
+            print('{:<55} {:.2f}s'.format(rendering[finished], wall_times[rendering[finished]]))
+
+    return wall_times
+
+
+# Runs one graph function and returns how long it took (module level so a process pool can pickle it)
+def timed_graph(graph, data, offline):
+    start = time.perf_counter()
+    graph(data, offline)
+    return time.perf_counter() - start
 
-    ply.sign_in('pnoonan32', open("PlotlyAPI.txt").read().strip())
-    url = ply.plot(fig, auto_open=False)
-    print(url)
-    open("Bike-Share-Trip-Path.html", "w").write(
-        "<h1>My cool graph</h1>" + tls.get_embed(url))
 
 if __name__ == "__main__":
     x = main()
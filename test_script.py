@@ -0,0 +1,615 @@
+"""
+Tests Section
+
+ Every path through the analyses must give the same answers on the same trips
+ Run code in terminal: python -m pytest test_script.py
+ The trips come from benchmark.write_trip_csv(), so no real LA Metro csv is needed
+"""
+
+import collections
+import csv
+import json
+import math
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import benchmark
+import script
+
+# Enough trips for every station, weekday and Passholder Type to show up, small enough to run in seconds
+TEST_ROWS = 3000
+
+
+@pytest.fixture(scope='module')
+def trips_csv(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('trips') / 'metro-bike-share-trip-data.csv')
+    benchmark.write_trip_csv(filename, TEST_ROWS)
+    return filename
+
+
+@pytest.fixture(scope='module')
+def rows(trips_csv):
+    return script.parse(trips_csv)
+
+
+@pytest.fixture(scope='module')
+def table(trips_csv):
+    return script.load_trip_table(trips_csv, cache=False)
+
+
+@pytest.fixture(scope='module')
+def expected(trips_csv):
+    return script.main(trips_csv, profile=False)
+
+
+# Same results down to float rounding (row and columnar paths add Durations & distances in different orders)
+def assert_same(actual, expected, path='result'):
+    if isinstance(expected, float) or isinstance(actual, float):
+        assert math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-12) \
+            or (math.isnan(actual) and math.isnan(expected)), path
+    elif isinstance(expected, np.ndarray):
+        assert actual.shape == expected.shape, path
+        assert np.allclose(actual, expected, equal_nan=True) if expected.dtype.kind == 'f' \
+            else np.array_equal(actual, expected), path
+    elif isinstance(expected, dict):
+        assert set(actual) == set(expected), path
+        for key in expected:
+            assert_same(actual[key], expected[key], '{}[{!r}]'.format(path, key))
+    elif isinstance(expected, (list, tuple)):
+        assert len(actual) == len(expected), path
+        for i, (value, expected_value) in enumerate(zip(actual, expected)):
+            assert_same(value, expected_value, '{}[{}]'.format(path, i))
+    elif hasattr(expected, '__dict__'):
+        assert type(actual) is type(expected), path
+        assert_same(vars(actual), vars(expected), path)
+    else:
+        assert actual == expected, path
+
+
+# Rewrites one column of "filename" in place: change(value) --> new value
+def rewrite_column(filename, column, change):
+    with open(filename, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        fieldnames, trips = reader.fieldnames, list(reader)
+
+    for trip in trips:
+        trip[column] = change(trip[column])
+
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(trips)
+
+
+def test_columnar_main_matches_main(trips_csv, expected):
+    assert_same(script.main(trips_csv, columnar=True, profile=False), expected)
+
+
+# A walk-up only drop: every Plan Duration is '' or '0', one character wide
+def test_columnar_blank_plan_durations(tmp_path):
+    filename = str(tmp_path / 'walk-ups.csv')
+    benchmark.write_trip_csv(filename, 49)
+    rewrite_column(filename, 'Plan Duration', lambda value: '0' if value == '0' else '')
+
+    table = script.load_trip_table(filename, cache=False)
+
+    assert set(table['Plan Duration'].tolist()) <= {0, -1}
+    assert_same(script.main(filename, columnar=True, profile=False), script.main(filename, profile=False))
+
+
+# A one column grouping (ex.: a new COMBINATIONS pie chart) must still pickle for ingest() & main(processes=...)
+def test_grouped_counts_pickle(trips_csv):
+    counts = script.feed(script.parse(trips_csv, stream=True),
+                         {'data': script.GroupedCounts({'Bikes': (['Bike ID'], None),
+                                                        'Routes': (['Trip Route Category', 'Passholder Type'], None)})})
+    copy = pickle.loads(pickle.dumps(counts['data']))
+
+    assert copy.result() == counts['data'].result()
+    assert sum(copy.result()['Bikes'].values()) == TEST_ROWS
+
+
+# cache.json / manifest.json as an older version wrote them (ex.: no 'build' folder yet) --> rebuilt, not a crash
+@pytest.mark.parametrize('metadata', [
+    {'size': 0, 'mtime_ns': 0, 'sha1': '', 'rows': 0, 'columns': [], 'labels': []},
+    {'version': script.CACHE_VERSION, 'size': 0},
+])
+def test_stale_cache_metadata_is_rebuilt(tmp_path, metadata):
+    filename = str(tmp_path / 'metro-bike-share-trip-data.csv')
+    benchmark.write_trip_csv(filename, 100)
+    script.load_trip_table(filename)
+    script.load_partitions(filename)
+
+    for directory, name in [(script.cache_directory(filename), 'cache.json'),
+                            (script.partition_directory(filename), 'manifest.json')]:
+        with open(os.path.join(directory, name), 'w') as metadata_file:
+            json.dump(dict(metadata, size=os.path.getsize(filename)), metadata_file)
+
+    assert len(script.load_trip_table(filename)) == 100
+    assert len(script.load_partitions(filename)) == 100
+    assert script.read_cache_metadata(script.cache_directory(filename))['version'] == script.CACHE_VERSION
+
+
+@pytest.mark.parametrize('text', ['', 'NaT', '2016-07-07', '2016-07-07T04:17', '2016-07-07T04:17:00Z',
+                                  '2016-07-07 04:17:00', '2016-13-07T04:17:00'])
+def test_parse_times_rejects_what_parse_time_rejects(text):
+    with pytest.raises(ValueError):
+        script.parse_time(text)
+    # One bad timestamp among good ones sends the chunk down the parse_time() path
+    with pytest.raises(ValueError):
+        script.parse_times(['2016-07-07T04:17:00', text])
+
+
+def test_parse_times_matches_parse_time():
+    # strptime also accepts unpadded fields, which the batch path must not turn away
+    texts = ['2016-07-07T04:17:00', '2016-12-31T23:59:59', '2016-7-7T4:17:00']
+    assert not script.iso_layout(texts)
+    assert script.iso_layout(texts[:2])
+
+    expected = np.array([script.parse_time(text) for text in texts], dtype='datetime64[s]')
+    assert_same(script.parse_times(texts), expected)
+    assert_same(script.parse_times(texts[:2]), expected[:2])
+
+
+def touch(filename):
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+# The first trip again at the end of the csv
+def append_trip(filename):
+    with open(filename) as csv_file:
+        trip = csv_file.readlines()[1]
+    with open(filename, 'a') as csv_file:
+        csv_file.write(trip)
+
+
+@pytest.fixture
+def fresh_csv(tmp_path):
+    filename = str(tmp_path / 'metro-bike-share-trip-data.csv')
+    benchmark.write_trip_csv(filename, TEST_ROWS // 3)
+    return filename
+
+
+def test_trip_cache_survives_touch(fresh_csv):
+    script.load_trip_table(fresh_csv)
+    metadata = script.read_cache_metadata(script.cache_directory(fresh_csv))
+
+    touch(fresh_csv)
+    table = script.read_trip_cache(fresh_csv)
+
+    assert table is not None and len(table) == TEST_ROWS // 3
+    touched = script.read_cache_metadata(script.cache_directory(fresh_csv))
+    assert touched['build'] == metadata['build']
+    assert touched['mtime_ns'] == os.stat(fresh_csv).st_mtime_ns
+
+
+def test_trip_cache_rebuilt_after_append(fresh_csv):
+    script.load_trip_table(fresh_csv)
+    directory = script.cache_directory(fresh_csv)
+    old_build = script.read_cache_metadata(directory)['build']
+
+    append_trip(fresh_csv)
+    assert script.read_trip_cache(fresh_csv) is None
+
+    table = script.load_trip_table(fresh_csv)
+    assert len(table) == TEST_ROWS // 3 + 1
+    assert_same(table.columns, script.load_trip_table(fresh_csv, cache=False).columns)
+    assert old_build not in os.listdir(directory)
+
+
+# "filename" copied into two csvs (header + first half, header + second half)
+def split_csv(filename, directory):
+    with open(filename) as csv_file:
+        header, *lines = csv_file.readlines()
+
+    halves = []
+    for i, part in enumerate([lines[:len(lines) // 2], lines[len(lines) // 2:]]):
+        half = os.path.join(directory, 'part-{}.csv'.format(i))
+        with open(half, 'w') as half_file:
+            half_file.writelines([header] + part)
+        halves.append(half)
+    return halves
+
+
+def test_ingest_split_files_matches_main(trips_csv, expected, tmp_path):
+    state_file = str(tmp_path / 'state.pickle')
+    for half in split_csv(trips_csv, str(tmp_path)):
+        x = script.ingest(half, state_file)
+
+    assert_same(x, expected)
+
+
+def test_ingest_same_file_twice_counts_once(trips_csv, expected, tmp_path):
+    state_file = str(tmp_path / 'state.pickle')
+    script.ingest(trips_csv, state_file)
+
+    assert_same(script.ingest(trips_csv, state_file), expected)
+
+
+def test_stale_state_asks_for_rebuild(trips_csv, tmp_path):
+    state_file = str(tmp_path / 'state.pickle')
+    script.ingest(trips_csv, state_file)
+
+    state = script.load_state(state_file)
+    state['version'] = script.STATE_VERSION - 1
+    script.save_state(state, state_file)
+
+    with pytest.raises(ValueError, match='rebuild state'):
+        script.ingest(trips_csv, state_file)
+
+
+def test_parallel_main_matches_main(trips_csv, expected):
+    assert_same(script.main(trips_csv, processes=2, profile=False), expected)
+
+
+# Partials travel as (Trip IDs, totals, counts); a Trip ID in two of them still averages over both
+def test_trip_time_partials_merge_repeated_trip_ids():
+    first, second = script.AverageTripTimeData(), script.AverageTripTimeData()
+    first.add({'Trip ID': '1', 'Duration': 60})
+    second.add({'Trip ID': '1', 'Duration': 180})
+    second.add({'Trip ID': '2', 'Duration': 60})
+
+    first.merge(pickle.loads(pickle.dumps(second)))
+
+    assert first.result() == {'1': {'Duration': 2.0}, '2': {'Duration': 1.0}}
+
+
+# Offline pages never reach Plotly's servers and load the one plotly.js written next to them
+def test_offline_publish_writes_local_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(script.ply, 'plot', lambda *args, **kwargs: pytest.fail('uploaded to Plotly'))
+    fig = dict(data=[dict(type='bar', x=['2016-07-07'], y=[1])], layout=script.themed_layout(title='Test'))
+
+    script.publish(fig, 'test.html', offline=True)
+    bundle = os.stat(script.PLOTLY_JS)
+    script.publish(fig, 'test-again.html', offline=True)
+
+    with open('test.html') as page:
+        html = page.read()
+    assert '<script src="{}"></script>'.format(script.PLOTLY_JS) in html
+    assert len(html) < bundle.st_size
+    # Already up to date, so not rewritten for the second page
+    assert os.stat(script.PLOTLY_JS).st_mtime_ns == bundle.st_mtime_ns
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_render_all_writes_every_page(expected, tmp_path, monkeypatch, processes):
+    monkeypatch.chdir(tmp_path)
+
+    wall_times = script.render_all(expected, offline=True, workers=3, processes=processes)
+
+    pages = [filename for graph, key, filename in script.GRAPHS]
+    assert sorted(wall_times) == sorted(pages)
+    for page in pages:
+        with open(page) as html:
+            assert script.PLOTLY_JS in html.read()
+
+
+# Stations scattered around downtown LA, plus one without coordinates that the index must leave out
+@pytest.fixture(scope='module')
+def station_index():
+    generator = np.random.default_rng(0)
+    latitudes = 34.05 + generator.normal(0, 0.03, 300)
+    longitudes = -118.25 + generator.normal(0, 0.03, 300)
+    coordinates = {str(3000 + i): (lat, lon) for i, (lat, lon) in enumerate(zip(latitudes.tolist(), longitudes.tolist()))}
+    coordinates['4108'] = (0.0, 0.0)
+    return script.StationIndex(coordinates, cell_km=0.25)
+
+
+# Points near the stations and far outside the grid, with every point x station distance worked out one by one
+@pytest.fixture(scope='module')
+def brute_force(station_index):
+    generator = np.random.default_rng(1)
+    latitudes = np.concatenate([34.05 + generator.normal(0, 0.05, 5000), [34.5, 33.0]])
+    longitudes = np.concatenate([-118.25 + generator.normal(0, 0.05, 5000), [-118.25, -119.0]])
+    distances = script.haversine(latitudes[:, None], longitudes[:, None],
+                                 station_index.latitudes[None, :], station_index.longitudes[None, :])
+    return latitudes, longitudes, distances
+
+
+def test_station_index_nearest_matches_brute_force(station_index, brute_force):
+    latitudes, longitudes, distances = brute_force
+
+    station_ids, nearest = station_index.nearest(latitudes, longitudes)
+
+    assert '4108' not in station_index.station_ids
+    assert np.allclose(nearest, distances.min(axis=1))
+    index = {station_id: i for i, station_id in enumerate(station_index.station_ids)}
+    assert np.allclose(distances[np.arange(len(latitudes)), [index[station_id] for station_id in station_ids]], nearest)
+
+
+def test_station_index_within_many_matches_brute_force(station_index, brute_force):
+    latitudes, longitudes, distances = brute_force
+
+    points, station_ids, found = station_index.within_many(latitudes, longitudes, 0.6)
+
+    index = {station_id: i for i, station_id in enumerate(station_index.station_ids)}
+    pairs = set(zip(points.tolist(), [index[station_id] for station_id in station_ids]))
+    assert pairs == set(zip(*np.nonzero(distances <= 0.6)))
+    assert np.allclose(found, distances[points, [index[station_id] for station_id in station_ids]])
+
+    point = int(points[0])
+    assert [station_id for station_id, km in station_index.within(latitudes[point], longitudes[point], 0.6)] \
+        == [station_index.station_ids[i] for i in np.argsort(distances[point], kind='stable') if distances[point, i] <= 0.6]
+
+
+def test_station_index_clusters_match_brute_force(station_index):
+    distances = script.haversine(station_index.latitudes[:, None], station_index.longitudes[:, None],
+                                 station_index.latitudes[None, :], station_index.longitudes[None, :])
+
+    # Flood fill over every pair closer than 0.4 km
+    unseen, expected = set(range(len(station_index))), set()
+    while unseen:
+        group, frontier = set(), [unseen.pop()]
+        while frontier:
+            i = frontier.pop()
+            group.add(i)
+            neighbours = set(np.flatnonzero(distances[i] <= 0.4).tolist()) & unseen
+            unseen -= neighbours
+            frontier.extend(neighbours)
+        expected.add(frozenset(station_index.station_ids[i] for i in group))
+
+    clusters = station_index.clusters(0.4)
+
+    assert {frozenset(cluster) for cluster in clusters} == expected
+    assert [len(cluster) for cluster in clusters] == sorted(map(len, clusters), reverse=True)
+
+
+@pytest.mark.parametrize('group', [None, 'Start Time', 'Start Hour', 'Passholder Type'])
+def test_route_ranking_matches_table(rows, table, group):
+    ranking = script.route_ranking(rows, group)
+    table_ranking = script.table_route_ranking(table, group)
+
+    assert_same(table_ranking.top_by_group(10), ranking.top_by_group(10))
+    assert_same(table_ranking.top(10), ranking.top(10))
+
+
+# Same entries, in the same order, as a full stable sort (many counts tie, so the tie order is tested too)
+@pytest.mark.parametrize('k', [0, 1, 5, 50, 1000])
+def test_top_k_indices_matches_full_sort(k):
+    counts = np.random.default_rng(k).integers(0, 20, 500)
+
+    assert script.top_k_indices(counts, k).tolist() == np.argsort(-counts, kind='stable')[:k].tolist()
+
+
+def test_route_ranking_top_matches_counter(rows):
+    routes = collections.Counter((row['Starting Station ID'], row['Ending Station ID']) for row in rows)
+
+    assert script.route_ranking(rows).top(20) == routes.most_common(20)
+
+
+@pytest.mark.parametrize('by', [None, 'Start Time', 'Start Hour'])
+def test_od_matrix_matches_table(rows, table, by):
+    od = script.od_matrix(rows, by)
+    table_od = script.table_od_matrix(table, by)
+
+    assert table_od.station_ids == od.station_ids
+    assert table_od.slices == od.slices
+    assert_same(table_od.dense(), od.dense())
+    assert_same(table_od.net_flow(), od.net_flow())
+    assert_same(table_od.imbalance(), od.imbalance())
+
+
+# The morning hours' matrix and flows, counted trip by trip
+def test_od_matrix_matches_trip_counts(rows):
+    od = script.od_matrix(rows, 'Start Hour')
+    hours = [7, 8, 9]
+
+    expected = np.zeros((len(od.station_ids), len(od.station_ids)), dtype=np.int64)
+    for row in rows:
+        if row['Start Time'].hour in hours:
+            expected[od.index[row['Starting Station ID']], od.index[row['Ending Station ID']]] += 1
+
+    assert_same(np.asarray(od.matrix(hours)), expected)
+    assert_same(np.asarray(od.outflow(hours)), expected.sum(axis=1))
+    assert_same(np.asarray(od.inflow(hours)), expected.sum(axis=0))
+    assert_same(np.asarray(od.net_flow(hours)), expected.sum(axis=0) - expected.sum(axis=1))
+
+
+@pytest.mark.parametrize('bucket_minutes', [15, 60])
+def test_station_time_series_matches_table(rows, table, bucket_minutes):
+    assert_same(script.table_station_time_series(table, bucket_minutes),
+                script.station_time_series(rows, bucket_minutes))
+
+
+# A two hour rolling window is the sum of the last eight 15 minute buckets
+def test_station_time_series_rolling_and_peaks(rows):
+    series = script.station_time_series(rows, 15)
+    station_id = series.station_ids[0]
+    departures = series.station(station_id, 'departures')
+
+    rolling = series.rolling(120, 'departures')[series.index[station_id]]
+    expected = [int(departures[max(0, end - 7):end + 1].sum()) for end in range(len(departures))]
+    assert rolling.tolist() == expected
+    assert departures.sum() == sum(row['Starting Station ID'] == station_id for row in rows)
+
+    peaks = series.peaks(station_id, minutes=120, top=3)
+    assert [trips for start, trips in peaks] == sorted(expected, reverse=True)[:3]
+
+
+def test_bike_utilization_matches_table(rows, table):
+    assert_same(script.table_bike_utilization(table), script.bike_utilization(rows))
+
+
+# Each bike's totals and idle gaps, walked trip by trip in Start Time order
+def test_bike_utilization_matches_trip_walk(rows):
+    bikes = script.bike_utilization(rows)
+
+    trips = collections.defaultdict(list)
+    for row in sorted(rows, key=lambda row: row['Start Time']):
+        trips[row['Bike ID']].append(row)
+
+    assert sorted(bikes.bike_ids) == sorted(trips)
+    for bike_id, bike_trips in trips.items():
+        gaps = [max(0, int((trip['Start Time'] - previous['End Time']).total_seconds()))
+                for previous, trip in zip(bike_trips, bike_trips[1:])]
+        bike = bikes.bike(bike_id)
+
+        assert bike['Trips'] == len(bike_trips)
+        assert bike['Ride Time(Hours)'] == sum(trip['Duration'] for trip in bike_trips) / 3600
+        assert bike['Idle Time(Hours)'] == sum(gaps) / 3600
+        assert bike['Longest Idle(Hours)'] == max(gaps, default=0) / 3600
+        assert bike['First Trip'] == bike_trips[0]['Start Time']
+        assert bike['Last Trip End'] == max(trip['End Time'] for trip in bike_trips)
+        assert bike['Last Seen Station'] == bike_trips[-1]['Ending Station ID']
+
+
+# {(date, label): trips} of main()'s per day counts, without the zero entries a query never produces
+def daily_counts(results):
+    return {(date, label): trips for date, counts in results.items() for label, trips in counts.items() if trips}
+
+
+def test_query_matches_main(table, expected):
+    trips = script.query(table).filter(weekday=True)
+
+    commuters = trips.exclude(plan_duration=0).exclude(passholder_type='Staff Annual') \
+        .group_by('Start Date', 'Passholder Type').agg(trips=(None, 'count'))
+    assert {key: values['trips'] for key, values in commuters.items()} \
+        == daily_counts(expected['Number of Regular Commuters'])
+
+    routes = trips.group_by('Start Date', 'Trip Route Category').agg(trips=(None, 'count'))
+    assert {key: values['trips'] for key, values in routes.items()} == daily_counts(expected['Most Popular Trip Routes'])
+
+    one_way = trips.filter(route='One Way').group_by('Start Date').agg(trips=(None, 'count'), seconds=('Duration', 'mean'))
+    assert_same({date: {'One Way': values['trips'], 'Duration': values['seconds'] / 60} for date, values in one_way.items()},
+                expected['Scatterplot'])
+
+
+# Every aggregation and predicate kind against the same trips picked out row by row
+def test_query_agg_matches_rows(rows, table):
+    stations = sorted({row['Starting Station ID'] for row in rows})[:10]
+    chosen = [row for row in rows
+              if '2016-08-01' <= row['Start Time'].strftime('%Y-%m-%d') <= '2016-09-30'
+              and row['Start Time'].weekday() in (5, 6)
+              and (row['Starting Station ID'] in stations or row['Ending Station ID'] in stations)
+              and row['Trip Route Category'] != 'Round Trip']
+
+    result = script.query(table).filter(start='2016-08-01', end='2016-09-30', weekday=[5, 6], station=stations) \
+        .exclude(route='Round Trip').group_by('Passholder Type') \
+        .agg(trips=(None, 'count'), total=('Duration', 'sum'), mean=('Duration', 'mean'),
+             shortest=('Duration', 'min'), last=('End Time', 'max'))
+
+    groups = collections.defaultdict(list)
+    for row in chosen:
+        groups[row['Passholder Type']].append(row)
+    assert len(chosen) > 20 and sorted(result) == sorted(groups)
+    for passholder_type, group in groups.items():
+        durations = [row['Duration'] for row in group]
+        assert_same(result[passholder_type], {
+            'trips': len(group), 'total': sum(durations), 'mean': sum(durations) / len(group),
+            'shortest': min(durations), 'last': max(row['End Time'] for row in group)})
+
+    assert script.query(table).filter(bike='no such bike').agg(trips=(None, 'count')) == {'trips': 0}
+    with pytest.raises(ValueError):
+        script.query(table).filter(colour='red')
+
+
+# A source with tables(first_day, last_day) is only asked for the days the filters allow
+class RecordingSource:
+
+    def __init__(self, table):
+        self.table = table
+        self.ranges = []
+
+    def tables(self, first_day, last_day):
+        self.ranges.append((first_day, last_day))
+        return [self.table]
+
+
+def test_query_pushes_date_range_down(table):
+    source = RecordingSource(table)
+
+    script.query(source).filter(start='2016-08-01').filter(start='2016-08-03', end='2016-08-31') \
+        .exclude(end='2016-08-10').count()
+
+    assert source.ranges == [(np.datetime64('2016-08-03'), np.datetime64('2016-08-31'))]
+
+
+def test_partitions_survive_touch(fresh_csv):
+    script.load_partitions(fresh_csv)
+    manifest_file = os.path.join(script.partition_directory(fresh_csv), 'manifest.json')
+    with open(manifest_file) as manifest:
+        build = json.load(manifest)['build']
+
+    touch(fresh_csv)
+    trips = script.load_partitions(fresh_csv)
+
+    assert trips.manifest['build'] == build
+    assert trips.manifest['mtime_ns'] == os.stat(fresh_csv).st_mtime_ns
+
+
+def test_partitions_rebuilt_after_append(fresh_csv):
+    old_build = script.load_partitions(fresh_csv).manifest['build']
+
+    append_trip(fresh_csv)
+    trips = script.load_partitions(fresh_csv)
+
+    assert len(trips) == TEST_ROWS // 3 + 1
+    assert sum(len(table) for table in trips.tables()) == TEST_ROWS // 3 + 1
+    assert old_build not in os.listdir(script.partition_directory(fresh_csv))
+
+
+def test_partitions_rebuilt_for_other_unit(fresh_csv):
+    months = script.load_partitions(fresh_csv, by='month')
+    days = script.load_partitions(fresh_csv, by='day')
+
+    assert days.manifest['by'] == 'day'
+    assert len(days.manifest['partitions']) > len(months.manifest['partitions'])
+
+
+# A date range only maps the months it overlaps, and still gives exactly the trips of that range
+def test_partitioned_query_matches_table(trips_csv, table, monkeypatch):
+    trips = script.load_partitions(trips_csv)
+    opened = []
+    partitions = trips.partitions
+
+    def recorded_partitions(first_day=None, last_day=None):
+        chosen = partitions(first_day, last_day)
+        opened.extend(partition['name'] for partition in chosen)
+        return chosen
+    monkeypatch.setattr(trips, 'partitions', recorded_partitions)
+
+    by_day = script.query(trips).filter(start='2016-08-10', end='2016-09-05').group_by('Start Date', 'Passholder Type')
+    expected_by_day = script.query(table).filter(start='2016-08-10', end='2016-09-05').group_by('Start Date', 'Passholder Type')
+
+    assert_same(by_day.agg(trips=(None, 'count'), mean=('Duration', 'mean')),
+                expected_by_day.agg(trips=(None, 'count'), mean=('Duration', 'mean')))
+    assert opened == ['2016-08', '2016-09']
+    assert sum(1 for row in trips.rows('2016-08-10', '2016-09-05')) == expected_by_day.count()
+
+
+# Why each of main()'s accumulators skips a row (first reason that applies), worked out separately from add()
+def skip_reason(name, row):
+    weekend = row['Start Time'].weekday() >= 5
+    reasons = {
+        'Station Pairs': [('empty coordinates', 0 in [row[column] for column in script.COORDINATE_COLUMNS])],
+        'Number of Regular Commuters': [('Plan Duration 0', row['Plan Duration'] == 0),
+                                        ('Staff Annual', row['Passholder Type'] == 'Staff Annual'),
+                                        ('weekend', weekend)],
+        'Most Popular Trip Routes': [('weekend', weekend)],
+        'Scatterplot': [('Duration 0', row['Duration'] == 0),
+                        ('Round Trip', row['Trip Route Category'] == 'Round Trip'),
+                        ('weekend', weekend)],
+        'Combinations': [('not has_plan_duration', row['Plan Duration'] == -1)],
+    }
+    return next((reason for reason, skips in reasons.get(name, []) if skips), None)
+
+
+def test_profiled_main_skip_counts(trips_csv, rows, expected, tmp_path):
+    report = str(tmp_path / 'profile.json')
+    x = script.profiled_main(trips_csv, report=report)
+
+    stages = {stage['stage']: stage for stage in x.pop('Profile')['stages']}
+    assert_same(x, expected)
+
+    for name in script.main_accumulators():
+        counts = collections.Counter(skip_reason(name, row) for row in rows)
+        counts.pop(None, None)
+        assert stages[name]['rows'] == TEST_ROWS
+        assert stages[name]['skipped'] == dict(counts), name
+
+    with open(report) as report_file:
+        assert json.load(report_file)['path'] == 'stream'